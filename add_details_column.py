@@ -1,20 +1,51 @@
 from app import app, db
 import sqlalchemy as sa
-from sqlalchemy.engine.reflection import Inspector
+
+def column_exists(conn, table, column):
+    """Check for a column with a single catalog query instead of full reflection"""
+    if conn.dialect.name == 'sqlite':
+        rows = conn.execute(sa.text(f"PRAGMA table_info({table})"))
+        return any(row[1] == column for row in rows)
+    return conn.execute(
+        sa.text(
+            "SELECT 1 FROM information_schema.columns "
+            "WHERE table_name = :table AND column_name = :column LIMIT 1"
+        ),
+        {"table": table, "column": column}
+    ).first() is not None
+
+def details_is_text(conn):
+    """Whether an existing Postgres details column still has the old TEXT type"""
+    return conn.execute(
+        sa.text(
+            "SELECT 1 FROM information_schema.columns "
+            "WHERE table_name = 'payment' AND column_name = 'details' AND data_type = 'text'"
+        )
+    ).first() is not None
 
 def add_details_column():
     """Add the details column to the Payment table if it doesn't exist"""
     
     with app.app_context():
-        inspector = Inspector.from_engine(db.engine)
-        columns = [column['name'] for column in inspector.get_columns('payment')]
+        with db.engine.connect() as conn:
+            has_details = column_exists(conn, 'payment', 'details')
+            is_postgres = conn.dialect.name == 'postgresql'
+            needs_jsonb = is_postgres and has_details and details_is_text(conn)
         
-        if 'details' not in columns:
+        if not has_details:
             print("Adding 'details' column to Payment table...")
             
             # Use SQLAlchemy Core to add the column
+            column_type = "JSONB" if is_postgres else "JSON"
+            with db.engine.begin() as conn:
+                conn.execute(sa.text(f"ALTER TABLE payment ADD COLUMN details {column_type}"))
+            
+            print("Migration completed successfully!")
+        elif needs_jsonb:
+            print("Converting 'details' column to JSONB...")
+            
             with db.engine.begin() as conn:
-                conn.execute(sa.text("ALTER TABLE payment ADD COLUMN details TEXT"))
+                conn.execute(sa.text("ALTER TABLE payment ALTER COLUMN details TYPE JSONB USING details::jsonb"))
             
             print("Migration completed successfully!")
         else:
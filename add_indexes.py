@@ -0,0 +1,17 @@
+from app import app, db
+
+def add_indexes():
+    """Create any indexes declared on the models that the database is missing"""
+    
+    with app.app_context():
+        with db.engine.begin() as conn:
+            for table in db.metadata.sorted_tables:
+                for index in table.indexes:
+                    # checkfirst skips indexes that already exist
+                    index.create(conn, checkfirst=True)
+                    print(f"Index '{index.name}' on {table.name} is in place.")
+        
+        print("Index migration completed successfully!")
+
+if __name__ == "__main__":
+    add_indexes()
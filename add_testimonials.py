@@ -1,18 +1,12 @@
 from app import create_app, db
 from models import User, Testimonial
 from datetime import datetime
+from sqlalchemy import select, insert, func
 
 app = create_app()
 
 def add_sample_testimonials():
     with app.app_context():
-        # Get some users to use as testimonial authors
-        users = User.query.all()
-        
-        if not users:
-            print("No users found in the database. Please create some users first.")
-            return
-        
         # Sample testimonials
         testimonials = [
             {
@@ -41,26 +35,32 @@ def add_sample_testimonials():
             }
         ]
         
+        # Get just enough user ids to use as testimonial authors
+        user_ids = db.session.scalars(select(User.id).limit(len(testimonials))).all()
+        
+        if not user_ids:
+            print("No users found in the database. Please create some users first.")
+            return
+        
         # Check if testimonials already exist
-        existing_testimonials = Testimonial.query.count()
+        existing_testimonials = db.session.scalar(select(func.count()).select_from(Testimonial))
         if existing_testimonials > 0:
             print(f"Found {existing_testimonials} existing testimonials. Skipping creation.")
             return
         
-        # Add testimonials
-        for i, testimonial_data in enumerate(testimonials):
-            # Cycle through users
-            user = users[i % len(users)]
-            
-            testimonial = Testimonial(
-                user_id=user.id,
-                content=testimonial_data["content"],
-                rating=testimonial_data["rating"],
-                is_approved=True,
-                created_at=datetime.utcnow()
-            )
-            
-            db.session.add(testimonial)
+        # Add testimonials, cycling through users, as one multi-row INSERT
+        now = datetime.utcnow()
+        rows = [
+            {
+                "user_id": user_ids[i % len(user_ids)],
+                "content": testimonial_data["content"],
+                "rating": testimonial_data["rating"],
+                "is_approved": True,
+                "created_at": now
+            }
+            for i, testimonial_data in enumerate(testimonials)
+        ]
+        db.session.execute(insert(Testimonial), rows)
         
         db.session.commit()
         print(f"Added {len(testimonials)} sample testimonials to the database.")
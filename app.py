@@ -1,35 +1,60 @@
 import os
 import logging
+import importlib
+import stripe
 from datetime import datetime
 
-from flask import Flask, render_template, redirect, url_for, flash, request, jsonify, session, send_from_directory
-from markupsafe import Markup
+from flask import Flask, render_template, redirect, url_for, flash, request, jsonify, session, send_from_directory, g
+from markupsafe import Markup, escape
 from flask_wtf.csrf import CSRFProtect
-from extensions import db, login_manager, mail
-from models import User, Notification, Contact
+from extensions import db, login_manager, mail, cache
+from models import User
 from flask_login import current_user
-
-# Import blueprints
-from routes.auth import bp as auth_bp
-from routes.admin import bp as admin_bp
-from routes.course import bp as course_bp
-from routes.users import bp as users_bp
-from routes.discussion import bp as discussion_bp
-from routes.notification import bp as notification_bp
-from routes.certificate import bp as certificate_bp
-from routes.assignment import bp as assignment_bp
-from routes.subscription import bp as subscription_bp
-from routes.contact import bp as contact_bp
-from routes.stripe_payment import bp as stripe_payment_bp
-from routes.payment import bp as payment_bp
-from routes.testimonial import bp as testimonial_bp
-from routes.quiz import bp as quiz_bp
-from routes.main import bp as main_bp
-
-# Set up logging
-logging.basicConfig(level=logging.DEBUG)
+from utils import get_unread_counts, wants_template_context
+from tasks import celery_init_app
+
+# Blueprints as (module, url_prefix). Modules are imported inside create_app so
+# that importing this module (e.g. from CLI scripts) stays cheap
+BLUEPRINTS = (
+    ('routes.main', None),  # Register main blueprint first
+    ('routes.auth', None),
+    ('routes.admin', '/admin'),
+    ('routes.course', None),
+    ('routes.users', None),
+    ('routes.discussion', None),
+    ('routes.notification', None),
+    ('routes.certificate', None),
+    ('routes.assignment', None),
+    ('routes.subscription', None),
+    ('routes.contact', None),
+    ('routes.stripe_payment', None),
+    ('routes.payment', None),
+    ('routes.testimonial', None),
+    ('routes.quiz', None),
+)
+
+# Set up logging (set LOG_LEVEL=DEBUG for verbose output)
+logging.basicConfig(level=os.environ.get("LOG_LEVEL", "INFO").upper())
 logger = logging.getLogger(__name__)
 
+# (upper bound in seconds, divisor, singular, plural) for the timeago filter
+_TIMEAGO_LADDER = (
+    (60, 1, 'second', 'seconds'),
+    (3600, 60, 'minute', 'minutes'),
+    (86400, 3600, 'hour', 'hours'),
+    (604800, 86400, 'day', 'days'),
+)
+
+# Upload folders whose files are named by content hash (utils.save_picture), so a
+# URL never changes content and browsers may cache it for good. In production
+# nginx should serve these directly, e.g.
+#   location /static/uploads/course_thumbnails/ { sendfile on; tcp_nopush on; expires 30d; }
+IMMUTABLE_STATIC_PREFIXES = ('/static/uploads/course_thumbnails/',)
+IMMUTABLE_MAX_AGE = 30 * 24 * 3600
+
+# Upload subfolders (under UPLOAD_FOLDER) created once at startup
+UPLOAD_SUBFOLDERS = ('content', 'course_thumbnails', 'profile_pics')
+
 def create_app():
     # Create the Flask app
     app = Flask(__name__)
@@ -38,17 +63,59 @@ def create_app():
     # Configure the database
     app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL", "sqlite:///elearning.db")
     app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-        "pool_recycle": 300,
+        "pool_recycle": int(os.environ.get("DB_POOL_RECYCLE", 300)),
         "pool_pre_ping": True,
     }
+    if app.config["SQLALCHEMY_DATABASE_URI"].startswith("postgres"):
+        # Server-side now() defaults must match the naive UTC datetimes used in Python
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"]["connect_args"] = {"options": "-c timezone=utc"}
+    if not app.config["SQLALCHEMY_DATABASE_URI"].startswith("sqlite"):
+        # Size the pool to the worker count; SQLite does not use these options
+        app.config["SQLALCHEMY_ENGINE_OPTIONS"].update({
+            "pool_size": int(os.environ.get("DB_POOL_SIZE", 10)),
+            "max_overflow": int(os.environ.get("DB_MAX_OVERFLOW", 20)),
+            # Fail fast when the pool is exhausted rather than queueing requests
+            "pool_timeout": int(os.environ.get("DB_POOL_TIMEOUT", 5)),
+        })
+    if os.environ.get("DATABASE_READ_URL"):
+        # Optional read replica for read-heavy queries (see utils.read_bind)
+        app.config["SQLALCHEMY_BINDS"] = {"replica": os.environ["DATABASE_READ_URL"]}
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 
     # Configure file upload settings
     app.config['UPLOAD_FOLDER'] = 'static/uploads'
     app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max upload size
+    # Behind nginx, set UPLOAD_ACCEL_PREFIX=/protected_uploads/ and let nginx send
+    # /uploads/ files itself:
+    #   location /protected_uploads/ { internal; alias /app/static/uploads/; sendfile on; tcp_nopush on; }
+    app.config['UPLOAD_ACCEL_PREFIX'] = os.environ.get('UPLOAD_ACCEL_PREFIX')
+    for folder in UPLOAD_SUBFOLDERS:
+        os.makedirs(os.path.join(app.root_path, app.config['UPLOAD_FOLDER'], folder), exist_ok=True)
+    
+    @app.after_request
+    def cache_immutable_uploads(response):
+        # Long-lived caching for hashed uploads that reach Flask's static handler
+        if response.status_code == 200 and request.path.startswith(IMMUTABLE_STATIC_PREFIXES):
+            response.headers['Cache-Control'] = f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+        return response
     
     # Configure pagination settings
     app.config['COURSES_PER_PAGE'] = 12  # Number of courses to display per page
+    app.config['ITEMS_PER_PAGE'] = 25  # Page size for dashboards and discussion lists
+
+    # Configure caching (use RedisCache + CACHE_REDIS_URL in production)
+    app.config['CACHE_TYPE'] = os.environ.get('CACHE_TYPE', 'SimpleCache')
+    app.config['CACHE_REDIS_URL'] = os.environ.get('CACHE_REDIS_URL')
+    app.config['CACHE_DEFAULT_TIMEOUT'] = 300
+
+    # Configure background jobs; without a broker, tasks run inline (eagerly)
+    celery_broker = os.environ.get('CELERY_BROKER_URL')
+    app.config['CELERY'] = {
+        'broker_url': celery_broker,
+        'result_backend': os.environ.get('CELERY_RESULT_BACKEND'),
+        'task_always_eager': not celery_broker,
+        'task_ignore_result': True,
+    }
 
     # Set up CSRF protection
     csrf = CSRFProtect(app)
@@ -57,56 +124,45 @@ def create_app():
     db.init_app(app)
     login_manager.init_app(app)
     mail.init_app(app)
+    cache.init_app(app)
+    celery_init_app(app)
+
+    # Flag lazy loads (N+1 queries) in development; nplusone is a dev-only dependency
+    if app.debug or os.environ.get("NPLUSONE") == "1":
+        try:
+            from nplusone.ext.flask_sqlalchemy import NPlusOne
+        except ImportError:
+            logger.warning("nplusone is not installed; N+1 query detection is disabled")
+        else:
+            app.config['NPLUSONE_RAISE'] = os.environ.get("NPLUSONE_RAISE") == "1"
+            NPlusOne(app)
 
     # Set up login manager
     login_manager.login_view = 'auth.login'
     login_manager.login_message_category = 'info'
 
     # Register blueprints
-    app.register_blueprint(main_bp)  # Register main blueprint first
-    app.register_blueprint(auth_bp)
-    app.register_blueprint(admin_bp, url_prefix='/admin')
-    app.register_blueprint(course_bp)
-    app.register_blueprint(users_bp)
-    app.register_blueprint(discussion_bp)
-    app.register_blueprint(notification_bp)
-    app.register_blueprint(certificate_bp)
-    app.register_blueprint(assignment_bp)
-    app.register_blueprint(subscription_bp)
-    app.register_blueprint(contact_bp)
-    app.register_blueprint(stripe_payment_bp)
-    app.register_blueprint(payment_bp)
-    app.register_blueprint(testimonial_bp)
-    app.register_blueprint(quiz_bp)
+    for module_name, url_prefix in BLUEPRINTS:
+        blueprint = importlib.import_module(module_name).bp
+        app.register_blueprint(blueprint, url_prefix=url_prefix)
 
     # Custom Jinja filters
     def timeago(date):
         """Convert datetime to a 'time ago' string"""
-        now = datetime.utcnow()
-        diff = now - date
-        
-        seconds = diff.total_seconds()
+        seconds = int((datetime.utcnow() - date).total_seconds())
         
-        if seconds < 60:
-            return f"{int(seconds)} seconds ago"
-        elif seconds < 3600:
-            minutes = seconds // 60
-            return f"{int(minutes)} {'minute' if minutes == 1 else 'minutes'} ago"
-        elif seconds < 86400:
-            hours = seconds // 3600
-            return f"{int(hours)} {'hour' if hours == 1 else 'hours'} ago"
-        elif seconds < 604800:
-            days = seconds // 86400
-            return f"{int(days)} {'day' if days == 1 else 'days'} ago"
-        else:
-            return date.strftime('%Y-%m-%d')
+        for limit, divisor, singular, plural in _TIMEAGO_LADDER:
+            if seconds < limit:
+                count = seconds // divisor
+                return f"{count} {singular if count == 1 else plural} ago"
+        return date.strftime('%Y-%m-%d')
 
     # nl2br filter for converting newlines to <br> tags
     def nl2br(value):
-        """Convert newlines to <br> tags"""
+        """Convert newlines to <br> tags, escaping the text in between"""
         if not value:
             return ""
-        return Markup(value.replace('\n', '<br>'))
+        return Markup('<br>\n').join(map(escape, value.split('\n')))
 
     # Register the filters with Jinja
     app.jinja_env.filters['timeago'] = timeago
@@ -114,38 +170,46 @@ def create_app():
 
     @login_manager.user_loader
     def load_user(user_id):
-        return db.session.get(User, int(user_id))
-
-    # Create database tables
-    with app.app_context():
-        try:
-            db.create_all()
-            logger.debug("Database tables created")
-        except Exception as e:
-            logger.error(f"Error creating database tables: {e}")
-            raise
+        # Memoize per request so repeated loads skip the session lookup
+        user_id = int(user_id)
+        loaded = g.setdefault('loaded_users', {})
+        if user_id not in loaded:
+            loaded[user_id] = db.session.get(User, user_id)
+        return loaded[user_id]
+
+    # Create database tables. Only on request (or for the local SQLite
+    # database) so production workers don't reflect the schema on every boot
+    default_auto_create = "1" if app.config["SQLALCHEMY_DATABASE_URI"].startswith("sqlite") else "0"
+    if os.environ.get("AUTO_CREATE_TABLES", default_auto_create) == "1":
+        with app.app_context():
+            try:
+                db.create_all()
+                logger.debug("Database tables created")
+            except Exception as e:
+                logger.error(f"Error creating database tables: {e}")
+                raise
 
     # Setup Stripe
     stripe_key = os.environ.get('STRIPE_SECRET_KEY')
+    app.config['STRIPE_SECRET_KEY'] = stripe_key
+    app.config['STRIPE_WEBHOOK_SECRET'] = os.environ.get('STRIPE_WEBHOOK_SECRET')
     if not stripe_key or stripe_key.startswith('sk_test_'):
         logger.warning("Using test Stripe API key. Set STRIPE_SECRET_KEY environment variable for production.")
+    stripe.api_key = stripe_key
+    # One HTTP client per process so Stripe calls reuse pooled keep-alive TLS
+    # connections. Its requests.Session is created on first use, so forking
+    # workers after create_app (gunicorn --preload, Celery prefork) is safe
+    stripe.default_http_client = stripe.RequestsClient(
+        timeout=int(os.environ.get('STRIPE_TIMEOUT', 10))
+    )
 
     logger.debug("App initialized")
 
     # Context processors for template variables
     @app.context_processor
     def inject_template_vars():
-        if current_user.is_authenticated:
-            unread_notifications = Notification.query.filter_by(
-                user_id=current_user.id,
-                is_read=False
-            ).count()
-            
-            unread_messages = Contact.query.filter_by(
-                recipient_id=current_user.id,
-                is_read=False
-            ).count()
-            
+        if wants_template_context() and current_user.is_authenticated:
+            unread_notifications, unread_messages = get_unread_counts(current_user.id)
             return {
                 'unread_notifications': unread_notifications,
                 'unread_messages': unread_messages
@@ -159,6 +223,7 @@ def create_app():
 
 # Create the app instance
 app = create_app()
+celery_app = app.extensions['celery']
 
 if __name__ == '__main__':
     app.run(debug=True)
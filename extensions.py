@@ -1,7 +1,12 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from flask_mail import Mail
+from flask_caching import Cache
 
-db = SQLAlchemy()
+# Sessions live for one request and every write path commits explicitly, so skip
+# the autoflush before each query and the attribute reload after each commit.
+# Code that needs pending changes visible to a query must flush() first
+db = SQLAlchemy(session_options={'expire_on_commit': False, 'autoflush': False})
 login_manager = LoginManager()
-mail = Mail() 
\ No newline at end of file
+mail = Mail()
+cache = Cache() 
\ No newline at end of file
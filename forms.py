@@ -9,7 +9,91 @@ from wtforms.validators import (
     Optional, NumberRange
 )
 from flask_login import current_user
-from models import User
+from sqlalchemy import select, exists, false
+from extensions import db, cache
+from models import User, Course
+from utils import ALLOWED_IMAGE_EXT
+
+USERNAME_TAKEN = 'Username is already taken. Please choose a different one.'
+EMAIL_TAKEN = 'Email is already registered. Please use a different one.'
+
+def check_user_taken(username=None, email=None):
+    """Return (username_taken, email_taken) from one EXISTS query; None skips a check"""
+    if username is None and email is None:
+        return False, False
+    row = db.session.execute(select(
+        exists().where(User.username == username) if username is not None else false(),
+        exists().where(User.email == email) if email is not None else false()
+    )).one()
+    return bool(row[0]), bool(row[1])
+
+# Select/radio choices shared by every form instance
+ROLE_CHOICES = (
+    ('student', 'Student'),
+    ('instructor', 'Instructor'),
+    ('admin', 'Admin')
+)
+CATEGORY_CHOICES = (
+    ('programming', 'Programming'),
+    ('design', 'Design'),
+    ('business', 'Business'),
+    ('marketing', 'Marketing'),
+    ('music', 'Music'),
+    ('photography', 'Photography'),
+    ('other', 'Other')
+)
+LEVEL_CHOICES = (
+    ('beginner', 'Beginner'),
+    ('intermediate', 'Intermediate'),
+    ('advanced', 'Advanced')
+)
+COURSE_TYPE_CHOICES = (
+    ('free', 'Free Course - Available to all students at no cost'),
+    ('paid', 'Paid Course - Students must purchase to access')
+)
+CONTENT_TYPE_CHOICES = (
+    ('video', 'Video'),
+    ('pdf', 'PDF Document'),
+    ('text', 'Text Content'),
+    ('assignment', 'Assignment')
+)
+QUESTION_TYPE_CHOICES = (
+    ('multiple_choice', 'Multiple Choice'),
+    ('true_false', 'True/False'),
+    ('short_answer', 'Short Answer')
+)
+TESTIMONIAL_TYPE_CHOICES = (
+    ('course', 'Course Testimonial'),
+    ('instructor', 'Instructor Testimonial'),
+    ('admin', 'Admin Testimonial')
+)
+RATING_CHOICES = (
+    (1, '1 Star'),
+    (2, '2 Stars'),
+    (3, '3 Stars'),
+    (4, '4 Stars'),
+    (5, '5 Stars')
+)
+
+CONTACT_RECIPIENTS_KEY = 'choices:contact_recipients'
+TESTIMONIAL_COURSES_KEY = 'choices:testimonial_courses'
+TESTIMONIAL_PEOPLE_KEY = 'choices:testimonial_people'
+
+def cached_choices(key, query, timeout=120):
+    """Return (id, label) choices for a two-column query, cached briefly"""
+    choices = cache.get(key)
+    if choices is None:
+        choices = [tuple(row) for row in db.session.execute(query).all()]
+        cache.set(key, choices, timeout=timeout)
+    return choices
+
+def invalidate_user_choices():
+    """Drop cached user select choices after a user is created, changed or deleted"""
+    cache.delete_many(CONTACT_RECIPIENTS_KEY, TESTIMONIAL_PEOPLE_KEY)
+
+def invalidate_course_choices():
+    """Drop cached course select choices after a course is created or changed"""
+    cache.delete(TESTIMONIAL_COURSES_KEY)
 
 class LoginForm(FlaskForm):
     email = StringField('Email', validators=[DataRequired(), Email()])
@@ -30,29 +114,23 @@ class RegistrationForm(FlaskForm):
         'Confirm Password',
         validators=[DataRequired(), EqualTo('password')]
     )
-    role = SelectField(
-        'Role',
-        choices=[
-            ('student', 'Student'),
-            ('instructor', 'Instructor'),
-            ('admin', 'Admin')
-        ]
-    )
+    role = SelectField('Role', choices=ROLE_CHOICES)
     submit = SubmitField('Register')
 
-    def validate_username(self, username):
-        user = User.query.filter_by(username=username.data).first()
-        if user:
-            raise ValidationError(
-                'Username is already taken. Please choose a different one.'
-            )
-
-    def validate_email(self, email):
-        user = User.query.filter_by(email=email.data).first()
-        if user:
-            raise ValidationError(
-                'Email is already registered. Please use a different one.'
-            )
+    def validate(self, **kwargs):
+        valid = super(RegistrationForm, self).validate(**kwargs)
+        
+        # Check username and email uniqueness together in one query
+        username_taken, email_taken = check_user_taken(
+            username=None if self.username.errors else self.username.data,
+            email=None if self.email.errors else self.email.data
+        )
+        if username_taken:
+            self.username.errors.append(USERNAME_TAKEN)
+        if email_taken:
+            self.email.errors.append(EMAIL_TAKEN)
+        
+        return valid and not (username_taken or email_taken)
 
 class ProfileUpdateForm(FlaskForm):
     username = StringField(
@@ -64,7 +142,7 @@ class ProfileUpdateForm(FlaskForm):
     phone = StringField('Phone Number', validators=[Optional(), Length(max=20)])
     profile_pic = FileField(
         'Profile Picture',
-        validators=[FileAllowed(['jpg', 'png', 'jpeg'])]
+        validators=[FileAllowed(sorted(ALLOWED_IMAGE_EXT))]
     )
     submit = SubmitField('Update')
 
@@ -73,45 +151,31 @@ class ProfileUpdateForm(FlaskForm):
         self.original_username = original_username
         self.original_email = original_email
 
-    def validate_username(self, username):
-        if username.data != self.original_username:
-            user = User.query.filter_by(username=username.data).first()
-            if user:
-                raise ValidationError(
-                    'Username is already taken. Please choose a different one.'
-                )
-
-    def validate_email(self, email):
-        if email.data != self.original_email:
-            user = User.query.filter_by(email=email.data).first()
-            if user:
-                raise ValidationError(
-                    'Email is already registered. Please use a different one.'
-                )
+    def validate(self, **kwargs):
+        valid = super(ProfileUpdateForm, self).validate(**kwargs)
+        
+        # Only changed values need a uniqueness check, done in one query
+        username_changed = not self.username.errors and self.username.data != self.original_username
+        email_changed = not self.email.errors and self.email.data != self.original_email
+        username_taken, email_taken = check_user_taken(
+            username=self.username.data if username_changed else None,
+            email=self.email.data if email_changed else None
+        )
+        if username_taken:
+            self.username.errors.append(USERNAME_TAKEN)
+        if email_taken:
+            self.email.errors.append(EMAIL_TAKEN)
+        
+        return valid and not (username_taken or email_taken)
 
 class CourseForm(FlaskForm):
     title = StringField('Course Title', validators=[DataRequired(), Length(max=200)])
     description = TextAreaField('Description', validators=[DataRequired()])
-    category = SelectField('Category', choices=[
-        ('programming', 'Programming'),
-        ('design', 'Design'),
-        ('business', 'Business'),
-        ('marketing', 'Marketing'),
-        ('music', 'Music'),
-        ('photography', 'Photography'),
-        ('other', 'Other')
-    ], validators=[DataRequired()])
-    level = SelectField('Level', choices=[
-        ('beginner', 'Beginner'),
-        ('intermediate', 'Intermediate'),
-        ('advanced', 'Advanced')
-    ], validators=[DataRequired()])
-    course_type = RadioField('Course Type', choices=[
-        ('free', 'Free Course - Available to all students at no cost'),
-        ('paid', 'Paid Course - Students must purchase to access')
-    ], default='free')
+    category = SelectField('Category', choices=CATEGORY_CHOICES, validators=[DataRequired()])
+    level = SelectField('Level', choices=LEVEL_CHOICES, validators=[DataRequired()])
+    course_type = RadioField('Course Type', choices=COURSE_TYPE_CHOICES, default='free')
     price = FloatField('Price (if paid course)', validators=[NumberRange(min=0)], default=0)
-    thumbnail = FileField('Thumbnail', validators=[FileAllowed(['jpg', 'png', 'jpeg'])])
+    thumbnail = FileField('Thumbnail', validators=[FileAllowed(sorted(ALLOWED_IMAGE_EXT))])
     max_enrollments = IntegerField('Maximum Enrollments', default=100, validators=[NumberRange(min=1)])
     enrollment_deadline = DateField('Enrollment Deadline', format='%Y-%m-%d', validators=[Optional()])
     duration_days = IntegerField('Course Duration (days)', default=365, 
@@ -128,12 +192,7 @@ class CourseForm(FlaskForm):
 
 class ContentForm(FlaskForm):
     title = StringField('Title', validators=[DataRequired(), Length(max=200)])
-    content_type = SelectField('Content Type', choices=[
-        ('video', 'Video'), 
-        ('pdf', 'PDF Document'), 
-        ('text', 'Text Content'),
-        ('assignment', 'Assignment')
-    ])
+    content_type = SelectField('Content Type', choices=CONTENT_TYPE_CHOICES)
     file = FileField('File Upload')
     text_content = TextAreaField('Text Content')
     order = IntegerField('Display Order', default=0)
@@ -148,11 +207,7 @@ class QuizForm(FlaskForm):
 
 class QuestionForm(FlaskForm):
     text = TextAreaField('Question Text', validators=[DataRequired()])
-    question_type = SelectField('Question Type', choices=[
-        ('multiple_choice', 'Multiple Choice'),
-        ('true_false', 'True/False'),
-        ('short_answer', 'Short Answer')
-    ])
+    question_type = SelectField('Question Type', choices=QUESTION_TYPE_CHOICES)
     points = IntegerField('Points', default=1, validators=[NumberRange(min=1)])
     submit = SubmitField('Save Question')
 
@@ -180,37 +235,47 @@ class ContactForm(FlaskForm):
     message = TextAreaField('Message', validators=[DataRequired(), Length(min=10, max=2000)])
     submit = SubmitField('Send Message')
 
+    @classmethod
+    def get_choices(cls):
+        """Recipient choices as (user id, username)"""
+        return cached_choices(
+            CONTACT_RECIPIENTS_KEY,
+            select(User.id, User.username).order_by(User.username)
+        )
+
 class AdminUserForm(FlaskForm):
     username = StringField('Username', validators=[DataRequired(), Length(min=3, max=20)])
     email = StringField('Email', validators=[DataRequired(), Email()])
-    role = SelectField('Role', choices=[
-        ('student', 'Student'), 
-        ('instructor', 'Instructor'), 
-        ('admin', 'Admin')
-    ])
+    role = SelectField('Role', choices=ROLE_CHOICES)
     is_approved = BooleanField('Approve Account')
     submit = SubmitField('Save User')
 
 class TestimonialForm(FlaskForm):
-    testimonial_type = SelectField('Testimonial Type', choices=[
-        ('course', 'Course Testimonial'),
-        ('instructor', 'Instructor Testimonial'),
-        ('admin', 'Admin Testimonial')
-    ], validators=[DataRequired()])
+    testimonial_type = SelectField('Testimonial Type', choices=TESTIMONIAL_TYPE_CHOICES, validators=[DataRequired()])
     
     course_id = SelectField('Course', coerce=int, validators=[Optional()])
     target_id = SelectField('Person', coerce=int, validators=[Optional()])
     
     content = TextAreaField('Your Testimonial', validators=[DataRequired(), Length(min=20, max=500)])
-    rating = RadioField('Rating', choices=[
-        (1, '1 Star'), 
-        (2, '2 Stars'), 
-        (3, '3 Stars'), 
-        (4, '4 Stars'), 
-        (5, '5 Stars')
-    ], coerce=int, validators=[DataRequired()])
+    rating = RadioField('Rating', choices=RATING_CHOICES, coerce=int, validators=[DataRequired()])
     submit = SubmitField('Submit Testimonial')
     
+    @classmethod
+    def get_course_choices(cls):
+        """Course choices as (course id, title) for published courses"""
+        return cached_choices(
+            TESTIMONIAL_COURSES_KEY,
+            select(Course.id, Course.title).where(Course.is_published == True).order_by(Course.title)
+        )
+    
+    @classmethod
+    def get_person_choices(cls):
+        """Person choices as (user id, username) for instructors and admins"""
+        return cached_choices(
+            TESTIMONIAL_PEOPLE_KEY,
+            select(User.id, User.username).where(User.role.in_(('instructor', 'admin'))).order_by(User.username)
+        )
+    
     def validate(self, **kwargs):
         if not super(TestimonialForm, self).validate(**kwargs):
             return False
@@ -1,56 +1,97 @@
-from flask import render_template
+from flask import render_template, g
 from flask_login import current_user
+from sqlalchemy import select, union_all, literal, null, cast
 
-# Import route modules
-from routes.auth import bp as auth_bp
-from routes.course import bp as course_bp
-from routes.discussion import bp as discussion_bp
-from routes.payment import bp as payment_bp
-from routes.admin import bp as admin_bp
-from routes.notification import bp as notification_bp
-from routes.contact import bp as contact_bp
-from routes.users import bp as users_bp
-from routes.subscription import bp as subscription_bp
-from routes.testimonial import bp as testimonial_bp
-from routes.certificate import bp as certificate_bp
-from routes.assignment import bp as assignment_bp
-from routes.stripe_payment import bp as stripe_payment_bp
+from extensions import db, cache
+from utils import HOME_CONTENT_KEY, get_unread_counts, wants_template_context, read_bind
+from models import User, Course, Testimonial, Notification
 
-from models import Course, Testimonial, Notification, Contact
+# Home page lists are plain dicts (so they can be cached) shaped like the ORM
+# objects home.html was written against: same field names, and the joined
+# name under course.instructor.username / testimonial.user.username
+HOME_COURSE_FIELDS = ('id', 'title', 'description', 'thumbnail', 'price', 'rating', 'instructor')
+HOME_TESTIMONIAL_FIELDS = ('id', 'content', 'rating', 'created_at', 'user')
 
-def register_routes(app):
-    # Register blueprints
-    app.register_blueprint(auth_bp)
-    app.register_blueprint(course_bp)
-    app.register_blueprint(discussion_bp)
-    app.register_blueprint(payment_bp)
-    app.register_blueprint(admin_bp, url_prefix='/admin')
-    app.register_blueprint(notification_bp)
-    app.register_blueprint(contact_bp)
-    app.register_blueprint(users_bp)
-    app.register_blueprint(subscription_bp)
-    app.register_blueprint(testimonial_bp)
-    app.register_blueprint(certificate_bp)
-    app.register_blueprint(assignment_bp)
-    app.register_blueprint(stripe_payment_bp)
+def get_home_content(limit=6):
+    """Fetch the home page courses and testimonials in a single round trip"""
+    # Both top-N lists go out as one UNION ALL with a `kind` discriminator and
+    # come back as plain dicts (see HOME_COURSE_FIELDS / HOME_TESTIMONIAL_FIELDS)
+    top_courses = (
+        select(
+            literal('course').label('kind'),
+            Course.id.label('id'),
+            Course.title.label('title'),
+            Course.description.label('body'),
+            Course.thumbnail.label('image'),
+            Course.price.label('price'),
+            Course.rating.label('rating'),
+            Course.created_at.label('created_at'),
+            User.username.label('username')
+        )
+        .join(User, User.id == Course.instructor_id)
+        .where(Course.is_published == True)
+        .order_by(Course.rating.desc(), Course.id.desc())
+        .limit(limit)
+        .subquery()
+    )
+    # Placeholder columns are cast to the course column types: Postgres types a
+    # bare NULL inside a derived table as text, which the UNION can't match
+    # against e.g. the float price column
+    latest_testimonials = (
+        select(
+            literal('testimonial').label('kind'),
+            Testimonial.id.label('id'),
+            cast(null(), Course.title.type).label('title'),
+            Testimonial.content.label('body'),
+            cast(null(), Course.thumbnail.type).label('image'),
+            cast(null(), Course.price.type).label('price'),
+            Testimonial.rating.label('rating'),
+            Testimonial.created_at.label('created_at'),
+            User.username.label('username')
+        )
+        .join(User, User.id == Testimonial.user_id)
+        .where(Testimonial.is_approved == True)
+        .order_by(Testimonial.created_at.desc())
+        .limit(limit)
+        .subquery()
+    )
+    rows = db.session.execute(
+        union_all(select(top_courses), select(latest_testimonials)),
+        bind_arguments=read_bind()
+    ).all()
+
+    courses = []
+    testimonials = []
+    for row in rows:
+        if row.kind == 'course':
+            courses.append(dict(zip(HOME_COURSE_FIELDS, (
+                row.id, row.title, row.body, row.image, row.price, row.rating, {'username': row.username}
+            ))))
+        else:
+            testimonials.append(dict(zip(HOME_TESTIMONIAL_FIELDS, (
+                row.id, row.body, row.rating, row.created_at, {'username': row.username}
+            ))))
+
+    # UNION ALL does not guarantee the order of the branches, so restore it here
+    courses.sort(key=lambda c: (c['rating'] or 0, c['id']), reverse=True)
+    testimonials.sort(key=lambda t: t['created_at'], reverse=True)
+    return courses, testimonials
+
+def get_cached_home_content():
+    """Home page lists from the cache, querying only on a miss"""
+    # The lists change rarely, so keep them cached for a few minutes; Course and
+    # Testimonial writes drop the entry on commit (see the listeners in models)
+    content = cache.get(HOME_CONTENT_KEY)
+    if content is None:
+        content = get_home_content()
+        cache.set(HOME_CONTENT_KEY, content, timeout=300)
+    return content
 
+def register_routes(app):
     # Register home route
     @app.route('/')
     def home():
-        courses = (
-            Course.query
-            .filter_by(is_published=True)
-            .order_by(Course.rating.desc())
-            .limit(6)
-            .all()
-        )
-        testimonials = (
-            Testimonial.query
-            .filter_by(is_approved=True)
-            .order_by(Testimonial.created_at.desc())
-            .limit(6)
-            .all()
-        )
+        courses, testimonials = get_cached_home_content()
         return render_template(
             'home.html',
             courses=courses,
@@ -58,29 +99,24 @@ def register_routes(app):
         )
 
 def notification_processor():
-    if current_user.is_authenticated:
-        unread_notifications = (
-            Notification.query
-            .filter_by(user_id=current_user.id, is_read=False)
-            .count()
-        )
-        unread_messages = (
-            Contact.query
-            .filter_by(recipient_id=current_user.id, is_read=False)
-            .count()
-        )
-        recent_notifications = (
-            Notification.query
-            .filter_by(user_id=current_user.id)
-            .order_by(Notification.created_at.desc())
-            .limit(5)
-            .all()
-        )
-        return {
-            'unread_notifications': unread_notifications,
-            'unread_messages': unread_messages,
-            'recent_notifications': recent_notifications
-        }
+    if wants_template_context() and current_user.is_authenticated:
+        # Context processors run on every render; build the values once per request
+        if 'notification_context' not in g:
+            # Both counts come from one query (and usually from the cache)
+            unread_notifications, unread_messages = get_unread_counts(current_user.id)
+            recent_notifications = (
+                Notification.query
+                .filter_by(user_id=current_user.id)
+                .order_by(Notification.created_at.desc())
+                .limit(5)
+                .all()
+            )
+            g.notification_context = {
+                'unread_notifications': unread_notifications,
+                'unread_messages': unread_messages,
+                'recent_notifications': recent_notifications
+            }
+        return g.notification_context
     return {
         'unread_notifications': 0,
         'unread_messages': 0,
@@ -1,51 +1,143 @@
-from datetime import datetime, timedelta
+import os
+import secrets
+from datetime import datetime, timedelta, timezone
 from werkzeug.security import generate_password_hash, check_password_hash
+from flask import g, has_app_context
 from flask_login import UserMixin
+from sqlalchemy import select, insert, update, case, func, event, inspect, or_, text, lambda_stmt
+from sqlalchemy.orm import Session, object_session
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.dialects.postgresql import JSONB
 from extensions import db
 
+# Loading strategy for one-to-many collections. Set STRICT_LOADING=1 (dev/CI) to
+# make any lazy collection load raise, so N+1 patterns surface immediately and
+# hot queries get an explicit selectinload()/joinedload() instead
+COLLECTION_LAZY = 'raise_on_sql' if os.environ.get('STRICT_LOADING') == '1' else 'select'
+
+# Password hashing: werkzeug's native scrypt with explicit cost parameters
+# (N=2**15, r=8, p=1). Hashes are ~160 chars, so password_hash stays String(256)
+PASSWORD_HASH_METHOD = 'scrypt:32768:8:1'
+PASSWORD_SALT_LENGTH = 16
+
+# Enrollment.flags bits (is_active / completed packed into one SMALLINT)
+ENROLLMENT_ACTIVE = 1
+ENROLLMENT_COMPLETED = 2
+
+# Fixed value sets, stored as native enums on Postgres (VARCHAR elsewhere)
+USER_ROLES = ('student', 'instructor', 'admin')
+COURSE_LEVELS = ('beginner', 'intermediate', 'advanced')
+CONTENT_TYPES = ('video', 'pdf', 'text', 'assignment')
+PAYMENT_METHODS = ('easyload', 'hesabpay', 'paypal', 'stripe')
+# 'initiating': created locally, Stripe checkout session still being created by a
+# background task. On PostgreSQL add it to the existing type with
+# ALTER TYPE payment_status ADD VALUE 'initiating'
+PAYMENT_STATUSES = ('initiating', 'pending', 'completed', 'failed')
+
+# Subscription plans: (id, name, duration_days). Seeded into the plan table on
+# create and mirrored here so renewals never query it; None means no expiry
+PLAN_UNLIMITED, PLAN_MONTHLY, PLAN_YEARLY = 1, 2, 3
+PLANS = (
+    (PLAN_UNLIMITED, 'unlimited', None),
+    (PLAN_MONTHLY, 'monthly', 30),
+    (PLAN_YEARLY, 'yearly', 365),
+)
+PLAN_NAMES = {plan_id: name for plan_id, name, _ in PLANS}
+PLAN_IDS = {name: plan_id for plan_id, name, _ in PLANS}
+PLAN_DURATIONS = {plan_id: days for plan_id, _, days in PLANS}
+
+# Timestamp columns (created_at, enrolled_at, ...) carry both default=datetime.utcnow
+# and server_default=func.now(). SQLAlchemy, ORM and Core insert() alike, always
+# sends the Python value, so the server default only stamps rows written outside
+# it (raw SQL, migration backfills). The Python default stays because databases
+# created before the server defaults have no column default to fall back on.
+
+# g is request-scoped, so every expiry check within one request shares a single
+# timestamp instead of calling utcnow() each time
+def _now():
+    """Current UTC time, memoized for the request"""
+    if not has_app_context():
+        return datetime.utcnow()
+    if 'utcnow' not in g:
+        g.utcnow = datetime.utcnow()
+    return g.utcnow
+
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), unique=True, nullable=False)
     email = db.Column(db.String(120), unique=True, nullable=False)
     password_hash = db.Column(db.String(256), nullable=False)
-    role = db.Column(db.String(10), nullable=False, default='student')  # student, instructor, admin
+    role = db.Column(db.Enum(*USER_ROLES, name='user_role'), nullable=False, default='student')
     is_approved = db.Column(db.Boolean, default=False)  # Account approval status
     approval_date = db.Column(db.DateTime, nullable=True)  # When the account was approved
     approved_by = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)  # Admin who approved
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=func.now())
     profile_pic = db.Column(db.String(200), default='default.jpg')
     bio = db.Column(db.Text, nullable=True)
     phone = db.Column(db.String(20), nullable=True)  # Optional phone number
     
     # Relationships
-    courses_created = db.relationship('Course', backref='instructor', lazy=True)
-    enrollments = db.relationship('Enrollment', backref='student', lazy=True)
-    discussions_created = db.relationship('Discussion', backref='author', lazy=True)
-    comments = db.relationship('Comment', backref='author', lazy=True)
-    payments = db.relationship('Payment', backref='user', lazy=True)
-    quiz_attempts = db.relationship('QuizAttempt', backref='student', lazy=True)
+    courses_created = db.relationship('Course', backref='instructor', lazy=COLLECTION_LAZY)
+    enrollments = db.relationship('Enrollment', backref='student', lazy=COLLECTION_LAZY)
+    discussions_created = db.relationship('Discussion', backref='author', lazy=COLLECTION_LAZY)
+    comments = db.relationship('Comment', backref='author', lazy=COLLECTION_LAZY)
+    payments = db.relationship('Payment', backref='user', lazy=COLLECTION_LAZY)
+    quiz_attempts = db.relationship('QuizAttempt', backref='student', lazy=COLLECTION_LAZY)
+    
+    # Indexes (partial: only the rows the admin pages filter for)
+    __table_args__ = (
+        db.Index('ix_user_pending_approval', 'id',
+                 postgresql_where=text('is_approved = false'), sqlite_where=text('is_approved = 0')),
+        db.Index('ix_user_role_partial', 'role',
+                 postgresql_where=text("role != 'student'"), sqlite_where=text("role != 'student'")),
+    )
     
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = generate_password_hash(
+            password, method=PASSWORD_HASH_METHOD, salt_length=PASSWORD_SALT_LENGTH
+        )
         
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        if not check_password_hash(self.password_hash, password):
+            return False
+        # Upgrade legacy (e.g. pbkdf2) hashes on successful login; the caller commits
+        if self.password_needs_rehash():
+            self.set_password(password)
+        return True
     
+    def password_needs_rehash(self):
+        return not self.password_hash.startswith(PASSWORD_HASH_METHOD + '$')
+    
+    # Role checks work both on instances and in queries (e.g. filter(User.is_instructor))
+    @hybrid_property
     def is_admin(self):
         return self.role == 'admin'
     
+    @hybrid_property
     def is_instructor(self):
-        return self.role == 'instructor' or self.role == 'admin'
+        return self.role in ('instructor', 'admin')
+    
+    @is_instructor.expression
+    def is_instructor(cls):
+        return cls.role.in_(('instructor', 'admin'))
     
+    @hybrid_property
     def is_student(self):
         return self.role == 'student'
     
-    def is_active(self):
-        # Admin accounts are always active
+    # Not named is_active: Flask-Login reads that (UserMixin's, always True) at
+    # login, and approval has never been a login gate
+    @hybrid_property
+    def is_account_approved(self):
+        # Admin accounts are always approved
         if self.role == 'admin':
             return True
         # Other accounts need approval
-        return self.is_approved
+        return bool(self.is_approved)
+    
+    @is_account_approved.expression
+    def is_account_approved(cls):
+        return or_(cls.role == 'admin', cls.is_approved.is_(True))
     
     def approve_account(self, admin_id):
         """Approve a user account"""
@@ -63,35 +155,45 @@ class Course(db.Model):
     description = db.Column(db.Text, nullable=True)
     thumbnail = db.Column(db.String(200), default='default_course.jpg')
     price = db.Column(db.Float, default=0.0)
-    rating = db.Column(db.Float, default=0.0)  # Average rating (0-5)
+    rating = db.Column(db.Float, default=0.0)  # Average rating (0-5), = rating_sum / rating_count
     instructor_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=func.now())
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=func.now(), onupdate=datetime.utcnow)
     is_published = db.Column(db.Boolean, default=False)
     max_enrollments = db.Column(db.Integer, default=100)  # Maximum allowed enrollments
     enrollment_deadline = db.Column(db.DateTime, nullable=True)  # Optional deadline for enrollment
     duration_days = db.Column(db.Integer, default=365)  # Course access duration in days
     category = db.Column(db.String(50), nullable=True)  # Course category
-    level = db.Column(db.String(20), nullable=True)  # Course difficulty level
+    level = db.Column(db.Enum(*COURSE_LEVELS, name='course_level'), nullable=True)  # Course difficulty level
+    
+    # Denormalized counters, maintained by the Enrollment/CourseRating listeners below
+    enrollment_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    rating_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    rating_sum = db.Column(db.Integer, default=0, server_default='0', nullable=False)
     
     # Relationships
-    enrollments = db.relationship('Enrollment', backref='course', lazy=True, cascade="all, delete-orphan")
-    contents = db.relationship('Content', backref='course', lazy=True, cascade="all, delete-orphan")
-    quizzes = db.relationship('Quiz', backref='course', lazy=True, cascade="all, delete-orphan")
-    discussions = db.relationship('Discussion', backref='course', lazy=True, cascade="all, delete-orphan")
+    enrollments = db.relationship('Enrollment', backref='course', lazy=COLLECTION_LAZY, cascade="all, delete-orphan")
+    contents = db.relationship('Content', backref='course', lazy=COLLECTION_LAZY, cascade="all, delete-orphan")
+    quizzes = db.relationship('Quiz', backref='course', lazy=COLLECTION_LAZY, cascade="all, delete-orphan")
+    discussions = db.relationship('Discussion', backref='course', lazy=COLLECTION_LAZY, cascade="all, delete-orphan")
+    
+    # Indexes
+    __table_args__ = (
+        db.Index('ix_course_pub_rating', 'is_published', 'rating'),  # home page top courses
+    )
     
     def __repr__(self):
         return f'<Course {self.title}>'
         
     def has_enrollment_capacity(self):
         """Check if course has capacity for more enrollments"""
-        return len(self.enrollments) < self.max_enrollments
+        return self.enrollment_count < self.max_enrollments
         
     def is_enrollment_open(self):
         """Check if enrollment deadline has passed"""
         if not self.enrollment_deadline:
             return True  # No deadline set means always open
-        return datetime.utcnow() < self.enrollment_deadline
+        return _now() < self.enrollment_deadline
 
     def calculate_expiry_date(self, enrollment_date):
         """Calculate the expiry date for a new enrollment"""
@@ -99,73 +201,203 @@ class Course(db.Model):
         
     def calculate_progress(self, student_id):
         """Calculate the progress of a student in this course"""
-        # Get the student's enrollment
-        enrollment = Enrollment.query.filter_by(
-            student_id=student_id,
-            course_id=self.id
+        # Fetch the enrollment's progress and whether the course has any
+        # content in a single query. lambda_stmt caches the compiled SQL, so
+        # repeat calls only bind new parameters
+        course_id = self.id
+        row = db.session.execute(
+            lambda_stmt(lambda: select(
+                Enrollment.progress,
+                select(Content.id).where(Content.course_id == course_id).exists()
+            ).where(
+                Enrollment.student_id == student_id,
+                Enrollment.course_id == course_id
+            ))
         ).first()
         
-        if not enrollment:
-            return 0
-            
-        # Get all content items for this course
-        total_content = Content.query.filter_by(
-            course_id=self.id
-        ).count()
-        if total_content == 0:
+        if not row or not row[1]:
             return 0
             
         # Since there's no direct relationship between enrollments and completed content,
         # we'll use the progress field from the enrollment itself
-        return enrollment.progress
+        return row[0]
+
+    @classmethod
+    def progress_map(cls, student_id, course_ids):
+        """Map course id -> progress for a student's enrollments, in one query"""
+        if not course_ids:
+            return {}
+        rows = db.session.execute(
+            select(Enrollment.course_id, Enrollment.progress).where(
+                Enrollment.student_id == student_id,
+                Enrollment.course_id.in_(course_ids)
+            )
+        )
+        return {course_id: progress or 0 for course_id, progress in rows}
+
+
+class Plan(db.Model):
+    id = db.Column(db.SmallInteger, primary_key=True)
+    name = db.Column(db.String(20), unique=True, nullable=False)
+    duration_days = db.Column(db.Integer, nullable=True)  # None = unlimited
+    
+    def __repr__(self):
+        return f'<Plan {self.name}>'
+
+
+@event.listens_for(Plan.__table__, 'after_create')
+def _seed_plans(target, connection, **kw):
+    connection.execute(
+        insert(target),
+        [{'id': plan_id, 'name': name, 'duration_days': days} for plan_id, name, days in PLANS]
+    )
 
 
 class Enrollment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     student_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=False)
-    enrolled_at = db.Column(db.DateTime, default=datetime.utcnow)
-    completed = db.Column(db.Boolean, default=False)
+    enrolled_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=func.now())
     progress = db.Column(db.Float, default=0.0)  # percentage completed
-    last_accessed = db.Column(db.DateTime, default=datetime.utcnow)
+    last_accessed = db.Column(db.DateTime, default=datetime.utcnow, server_default=func.now())
     expires_at = db.Column(db.DateTime, nullable=True)
-    subscription_type = db.Column(db.String(20), default='unlimited')  # unlimited, monthly, yearly
-    is_active = db.Column(db.Boolean, default=True)
+    plan_id = db.Column(db.SmallInteger, db.ForeignKey('plan.id'), default=PLAN_UNLIMITED,
+                        server_default=str(PLAN_UNLIMITED), nullable=False)
     subscription_renewed = db.Column(db.DateTime, nullable=True)
+    flags = db.Column(db.SmallInteger, default=ENROLLMENT_ACTIVE, server_default='1', nullable=False)
+    
+    # Indexes
+    __table_args__ = (
+        db.Index('ix_enrollment_student_course', 'student_id', 'course_id', unique=True),  # Enrollment.find; no duplicates
+        db.Index('ix_enrollment_course_active', 'course_id', 'flags'),
+    )
     
     def __repr__(self):
         return f'<Enrollment {self.student_id} - {self.course_id}>'
     
+    def _set_flag(self, bit, value):
+        flags = ENROLLMENT_ACTIVE if self.flags is None else self.flags
+        self.flags = flags | bit if value else flags & ~bit
+    
+    @hybrid_property
+    def is_active(self):
+        return bool((self.flags if self.flags is not None else ENROLLMENT_ACTIVE) & ENROLLMENT_ACTIVE)
+    
+    @is_active.setter
+    def is_active(self, value):
+        self._set_flag(ENROLLMENT_ACTIVE, value)
+    
+    @is_active.expression
+    def is_active(cls):
+        return cls.flags.op('&')(ENROLLMENT_ACTIVE) != 0
+    
+    @hybrid_property
+    def completed(self):
+        return bool((self.flags or 0) & ENROLLMENT_COMPLETED)
+    
+    @completed.setter
+    def completed(self, value):
+        self._set_flag(ENROLLMENT_COMPLETED, value)
+    
+    @completed.expression
+    def completed(cls):
+        return cls.flags.op('&')(ENROLLMENT_COMPLETED) != 0
+    
+    @hybrid_property
+    def subscription_type(self):
+        return PLAN_NAMES.get(self.plan_id if self.plan_id is not None else PLAN_UNLIMITED)
+    
+    @subscription_type.setter
+    def subscription_type(self, name):
+        self.plan_id = PLAN_IDS[name]
+    
+    @subscription_type.expression
+    def subscription_type(cls):
+        return case(PLAN_NAMES, value=cls.plan_id)
+    
     def is_expired(self):
         """Check if the enrollment has expired"""
         if not self.expires_at:
             return False
-        return datetime.utcnow() > self.expires_at
+        return _now() > self.expires_at
     
     def days_until_expiry(self):
         """Calculate days remaining until expiration"""
         if not self.expires_at:
             return None
-        delta = self.expires_at - datetime.utcnow()
+        delta = self.expires_at - _now()
         return max(0, delta.days)
     
-    def renew_subscription(self, duration_days=30):
-        """Renew the subscription for a specified number of days"""
-        if self.expires_at and datetime.utcnow() < self.expires_at:
+    def renew_subscription(self, plan_id=PLAN_MONTHLY):
+        """Renew the subscription for another plan period (the caller commits)"""
+        self.plan_id = plan_id
+        self.subscription_renewed = datetime.utcnow()
+        self.is_active = True
+        
+        duration_days = PLAN_DURATIONS[plan_id]
+        if duration_days is None:
+            self.expires_at = None
+        elif self.expires_at and datetime.utcnow() < self.expires_at:
             # If not expired, add to existing expiry date
             self.expires_at = self.expires_at + timedelta(days=duration_days)
         else:
             # If expired, set from current date
             self.expires_at = datetime.utcnow() + timedelta(days=duration_days)
-        
-        self.subscription_renewed = datetime.utcnow()
-        self.is_active = True
-        db.session.commit()
 
     def set_expiry_date(self):
-        """Set the expiry date based on course duration"""
+        """Set the expiry date based on course duration (the caller commits)"""
         self.expires_at = self.course.calculate_expiry_date(self.enrolled_at)
-        db.session.commit()
+
+    @classmethod
+    def bulk_renew(cls, ids, plan_id=PLAN_MONTHLY):
+        """Renew many enrollments with a single UPDATE (the caller commits)"""
+        now = datetime.utcnow()
+        duration_days = PLAN_DURATIONS[plan_id]
+        if duration_days is None:
+            expires_at = None
+        else:
+            extension = timedelta(days=duration_days)
+            expires_at = case(
+                (cls.expires_at > now, cls.expires_at + extension),
+                else_=now + extension
+            )
+        db.session.execute(
+            update(cls)
+            .where(cls.id.in_(ids))
+            .values(
+                expires_at=expires_at,
+                plan_id=plan_id,
+                subscription_renewed=now,
+                flags=cls.flags.op('|')(ENROLLMENT_ACTIVE)
+            )
+            .execution_options(synchronize_session=False)
+        )
+
+    @classmethod
+    def find(cls, student_id, course_id):
+        """Fetch a student's enrollment in a course (cached compiled statement)"""
+        return db.session.scalars(
+            lambda_stmt(lambda: select(Enrollment).where(
+                Enrollment.student_id == student_id,
+                Enrollment.course_id == course_id
+            ))
+        ).first()
+
+    @classmethod
+    def insert_ignore(cls, student_id, course_id):
+        """Enroll a student unless already enrolled, via INSERT ... ON CONFLICT DO NOTHING (the caller commits)"""
+        from utils import dialect_insert
+        inserted = db.session.execute(
+            dialect_insert(cls)
+            .values(student_id=student_id, course_id=course_id)
+            .on_conflict_do_nothing(index_elements=['student_id', 'course_id'])
+            .returning(cls.id)
+        ).first() is not None
+        if inserted:
+            # Core inserts skip the ORM listeners, so keep the counter and cache in step here
+            _adjust_course_counters(db.session.connection(), course_id, enrollments=1)
+            mark_course_analytics_dirty(db.session, course_id)
+        return inserted
 
     def has_access(self):
         """Check if the student has access to the course"""
@@ -176,12 +408,12 @@ class Content(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=False)
     title = db.Column(db.String(200), nullable=False)
-    content_type = db.Column(db.String(20), nullable=False)  # video, pdf, text, assignment
+    content_type = db.Column(db.Enum(*CONTENT_TYPES, name='content_type'), nullable=False)
     file_path = db.Column(db.String(255), nullable=True)
     text_content = db.Column(db.Text, nullable=True)
     order = db.Column(db.Integer, default=0)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=func.now())
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=func.now(), onupdate=datetime.utcnow)
     
     def __repr__(self):
         return f'<Content {self.title}>'
@@ -193,12 +425,12 @@ class Lesson(db.Model):
     title = db.Column(db.String(200), nullable=False)
     description = db.Column(db.Text, nullable=True)
     order = db.Column(db.Integer, default=0)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=func.now())
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=func.now(), onupdate=datetime.utcnow)
     
     # Relationships
     course = db.relationship('Course', backref='lessons')
-    completed_by = db.relationship('CompletedLesson', backref='lesson', lazy=True)
+    completed_by = db.relationship('CompletedLesson', backref='lesson', lazy=COLLECTION_LAZY)
     
     def __repr__(self):
         return f'<Lesson {self.title}>'
@@ -208,11 +440,16 @@ class CompletedLesson(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     student_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     lesson_id = db.Column(db.Integer, db.ForeignKey('lesson.id'), nullable=False)
-    completed_at = db.Column(db.DateTime, default=datetime.utcnow)
+    completed_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=func.now())
     
     # Relationships
     student = db.relationship('User', backref='completed_lessons')
     
+    # Indexes
+    __table_args__ = (
+        db.Index('ix_completed_lesson_student_lesson', 'student_id', 'lesson_id'),
+    )
+    
     def __repr__(self):
         return f'<CompletedLesson {self.student_id} - {self.lesson_id}>'
 
@@ -223,10 +460,10 @@ class Assignment(db.Model):
     description = db.Column(db.Text, nullable=False)
     due_date = db.Column(db.DateTime, nullable=False)
     course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=func.now())
     
-    course = db.relationship('Course', backref=db.backref('assignments', lazy=True))
-    submissions = db.relationship('AssignmentSubmission', backref='assignment', lazy=True)
+    course = db.relationship('Course', backref=db.backref('assignments', lazy=COLLECTION_LAZY))
+    submissions = db.relationship('AssignmentSubmission', backref='assignment', lazy=COLLECTION_LAZY)
 
     def __repr__(self):
         return f'<Assignment {self.title}>'
@@ -238,7 +475,7 @@ class AssignmentSubmission(db.Model):
     student_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     submission_file = db.Column(db.String(255), nullable=True)
     submission_text = db.Column(db.Text, nullable=True)
-    submitted_at = db.Column(db.DateTime, default=datetime.utcnow)
+    submitted_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=func.now())
     grade = db.Column(db.Float, nullable=True)
     feedback = db.Column(db.Text, nullable=True)
     graded_at = db.Column(db.DateTime, nullable=True)
@@ -259,11 +496,11 @@ class Quiz(db.Model):
     description = db.Column(db.Text, nullable=True)
     time_limit = db.Column(db.Integer, default=0)  # time in minutes, 0 means no limit
     passing_score = db.Column(db.Float, default=70.0)  # percentage needed to pass
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=func.now())
     
     # Relationships
-    questions = db.relationship('Question', backref='quiz', lazy=True, cascade="all, delete-orphan")
-    attempts = db.relationship('QuizAttempt', backref='quiz', lazy=True, cascade="all, delete-orphan")
+    questions = db.relationship('Question', backref='quiz', lazy=COLLECTION_LAZY, cascade="all, delete-orphan")
+    attempts = db.relationship('QuizAttempt', backref='quiz', lazy=COLLECTION_LAZY, cascade="all, delete-orphan")
     
     def __repr__(self):
         return f'<Quiz {self.title}>'
@@ -277,7 +514,7 @@ class Question(db.Model):
     points = db.Column(db.Integer, default=1)
     
     # Relationships
-    answers = db.relationship('Answer', backref='question', lazy=True, cascade="all, delete-orphan")
+    answers = db.relationship('Answer', backref='question', lazy=COLLECTION_LAZY, cascade="all, delete-orphan")
     
     def __repr__(self):
         return f'<Question {self.id}>'
@@ -299,9 +536,14 @@ class QuizAttempt(db.Model):
     student_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     score = db.Column(db.Float, default=0.0)
     completed = db.Column(db.Boolean, default=False)
-    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=func.now())
     completed_at = db.Column(db.DateTime, nullable=True)
     
+    # Indexes
+    __table_args__ = (
+        db.Index('ix_quiz_attempt_quiz_student', 'quiz_id', 'student_id', 'completed'),
+    )
+    
     def __repr__(self):
         return f'<QuizAttempt {self.id}>'
 
@@ -312,11 +554,21 @@ class Discussion(db.Model):
     author_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     title = db.Column(db.String(200), nullable=False)
     content = db.Column(db.Text, nullable=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=func.now())
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=func.now(), onupdate=datetime.utcnow)
+    views = db.Column(db.Integer, default=0, server_default='0', nullable=False)
+    # Denormalized comment total, kept in step by the Comment insert/delete listeners below
+    comment_count = db.Column(db.Integer, default=0, server_default='0', nullable=False)
     
     # Relationships
-    comments = db.relationship('Comment', backref='discussion', lazy=True, cascade="all, delete-orphan")
+    comments = db.relationship('Comment', backref='discussion', lazy=COLLECTION_LAZY,
+                               cascade="all, delete-orphan", passive_deletes=True)
+    
+    # Indexes
+    __table_args__ = (
+        # course_discussions keyset pages (newest first, read by a backward index scan)
+        db.Index('ix_discussion_course_created', 'course_id', 'created_at', 'id'),
+    )
     
     def __repr__(self):
         return f'<Discussion {self.title}>'
@@ -324,17 +576,23 @@ class Discussion(db.Model):
 
 class Comment(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    discussion_id = db.Column(db.Integer, db.ForeignKey('discussion.id'), nullable=False)
+    discussion_id = db.Column(db.Integer, db.ForeignKey('discussion.id', ondelete='CASCADE'), nullable=False)
     author_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     parent_id = db.Column(db.Integer, db.ForeignKey('comment.id'), nullable=True)
     content = db.Column(db.Text, nullable=False)
     is_solution = db.Column(db.Boolean, default=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=func.now())
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=func.now(), onupdate=datetime.utcnow)
     
     # Recursive relationship for replies
     replies = db.relationship('Comment', backref=db.backref('parent', remote_side=[id]),
-                             lazy='dynamic', cascade='all, delete-orphan')
+                             lazy='select', cascade='all, delete-orphan')
+    
+    # Indexes
+    __table_args__ = (
+        db.Index('ix_comment_disc_parent', 'discussion_id', 'parent_id'),
+        db.Index('ix_comment_disc_created', 'discussion_id', 'created_at', 'id'),  # view_thread keyset pages
+    )
     
     def __repr__(self):
         return f'<Comment {self.id}>'
@@ -346,14 +604,23 @@ class Payment(db.Model):
     course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=False)
     amount = db.Column(db.Float, nullable=False)
     payment_id = db.Column(db.String(100), nullable=True)  # external payment id (stripe, etc)
-    payment_method = db.Column(db.String(20), default='easyload')  # easyload, hesabpay, paypal, stripe
-    status = db.Column(db.String(20), default='pending')  # pending, completed, failed
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
-    details = db.Column(db.Text, nullable=True)  # JSON-encoded payment details
+    payment_method = db.Column(db.Enum(*PAYMENT_METHODS, name='payment_method'), default='easyload')
+    status = db.Column(db.Enum(*PAYMENT_STATUSES, name='payment_status'), default='pending')
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=func.now())
+    details = db.Column(db.JSON().with_variant(JSONB, 'postgresql'), nullable=True)  # payment details dict
     
     # Reference to course
     course = db.relationship('Course', backref='payments')
     
+    # Indexes
+    __table_args__ = (
+        db.Index('ix_payment_user_course_status', 'user_id', 'course_id', 'status'),
+        db.Index('ix_payment_course_status', 'course_id', 'status'),
+        db.Index('ix_payment_user_status', 'user_id', 'status'),  # a user's payments by status
+        db.Index('ix_payment_payment_id', 'payment_id', unique=True),  # webhook upserts by Stripe session id
+        db.Index('ix_payment_details_gin', 'details', postgresql_using='gin').ddl_if(dialect='postgresql'),
+    )
+    
     def __repr__(self):
         return f'<Payment {self.id}>'
         
@@ -366,13 +633,38 @@ class Notification(db.Model):
     is_read = db.Column(db.Boolean, default=False)
     notification_type = db.Column(db.String(20), nullable=False)  # enrollment, payment, content, etc
     related_id = db.Column(db.Integer, nullable=True)  # ID of related item (course_id, payment_id, etc)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=func.now())
     
     # Reference to user
     user = db.relationship('User', backref='notifications')
     
+    # Indexes
+    __table_args__ = (
+        db.Index('ix_notification_user_read', 'user_id', 'is_read'),  # unread badge counts
+    )
+    
     def __repr__(self):
         return f'<Notification {self.id}: {self.title}>'
+
+    @classmethod
+    def bulk_create(cls, user_ids, *, title, message, notification_type, related_id=None, batch_size=10000):
+        """Notify many users with batched multi-row INSERTs (the caller commits)"""
+        now = datetime.utcnow()
+        rows = [
+            {
+                'user_id': user_id,
+                'title': title,
+                'message': message,
+                'notification_type': notification_type,
+                'related_id': related_id,
+                'is_read': False,
+                'created_at': now,
+            }
+            for user_id in user_ids
+        ]
+        for start in range(0, len(rows), batch_size):
+            db.session.execute(insert(cls), rows[start:start + batch_size])
+        return len(rows)
         
 class Contact(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -381,12 +673,17 @@ class Contact(db.Model):
     subject = db.Column(db.String(100), nullable=False)
     message = db.Column(db.Text, nullable=False)
     is_read = db.Column(db.Boolean, default=False)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=func.now())
     
     # Relationships
     sender = db.relationship('User', foreign_keys=[sender_id], backref='messages_sent')
     recipient = db.relationship('User', foreign_keys=[recipient_id], backref='messages_received')
     
+    # Indexes
+    __table_args__ = (
+        db.Index('ix_contact_recipient_read', 'recipient_id', 'is_read'),  # unread badge counts
+    )
+    
     def __repr__(self):
         return f'<Contact {self.id}: {self.subject}>'
 
@@ -397,7 +694,7 @@ class Testimonial(db.Model):
     content = db.Column(db.Text, nullable=False)
     rating = db.Column(db.Integer, default=5)  # Rating from 1-5
     is_approved = db.Column(db.Boolean, default=False)  # Admin must approve testimonials
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=func.now())
     
     # New fields for multiple testimonials
     course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=True)
@@ -409,6 +706,11 @@ class Testimonial(db.Model):
     course = db.relationship('Course', backref='testimonials')
     target = db.relationship('User', foreign_keys=[target_id], backref='received_testimonials')
     
+    # Indexes
+    __table_args__ = (
+        db.Index('ix_testimonial_approved_created', 'is_approved', 'created_at'),  # home page testimonials
+    )
+    
     def __repr__(self):
         return f'<Testimonial {self.id} by {self.user.username}>'
 
@@ -418,7 +720,7 @@ class CourseRating(db.Model):
     student_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=False)
     rating = db.Column(db.Integer, nullable=False)  # Rating from 1-5
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, server_default=func.now())
     
     # Relationships
     student = db.relationship('User', backref='course_ratings')
@@ -427,17 +729,85 @@ class CourseRating(db.Model):
     # Constraints
     __table_args__ = (
         db.UniqueConstraint('student_id', 'course_id', name='unique_student_course_rating'),
+        db.Index('ix_course_rating_course', 'course_id'),
     )
     
     def __repr__(self):
         return f'<CourseRating {self.id}: {self.rating} stars by student {self.student_id} for course {self.course_id}>'
 
 
+# Counter maintenance: each Enrollment/CourseRating flush issues a single
+# UPDATE on its course row, so reads never have to COUNT/AVG
+def _adjust_course_counters(connection, course_id, enrollments=0, ratings=0, rating_delta=0):
+    course = Course.__table__
+    values = {}
+    if enrollments:
+        values['enrollment_count'] = course.c.enrollment_count + enrollments
+    if ratings or rating_delta:
+        new_count = course.c.rating_count + ratings
+        new_sum = course.c.rating_sum + rating_delta
+        values['rating_count'] = new_count
+        values['rating_sum'] = new_sum
+        # SET expressions see the old row, so the average is computed from the new totals
+        values['rating'] = case((new_count > 0, new_sum * 1.0 / new_count), else_=0.0)
+    connection.execute(update(course).where(course.c.id == course_id).values(**values))
+
+
+@event.listens_for(Enrollment, 'after_insert')
+def _enrollment_inserted(mapper, connection, target):
+    _adjust_course_counters(connection, target.course_id, enrollments=1)
+
+
+@event.listens_for(Enrollment, 'after_delete')
+def _enrollment_deleted(mapper, connection, target):
+    _adjust_course_counters(connection, target.course_id, enrollments=-1)
+
+
+@event.listens_for(CourseRating, 'after_insert')
+def _rating_inserted(mapper, connection, target):
+    _adjust_course_counters(connection, target.course_id, ratings=1, rating_delta=target.rating)
+
+
+@event.listens_for(CourseRating, 'after_delete')
+def _rating_deleted(mapper, connection, target):
+    _adjust_course_counters(connection, target.course_id, ratings=-1, rating_delta=-target.rating)
+
+
+@event.listens_for(CourseRating, 'after_update')
+def _rating_updated(mapper, connection, target):
+    history = inspect(target).attrs.rating.history
+    if history.deleted and history.added:
+        _adjust_course_counters(
+            connection, target.course_id,
+            rating_delta=history.added[0] - history.deleted[0]
+        )
+
+
+def _adjust_comment_count(connection, discussion_id, delta):
+    discussion = Discussion.__table__
+    connection.execute(
+        update(discussion)
+        .where(discussion.c.id == discussion_id)
+        # updated_at is pinned: a new or removed comment is not an edit of the thread
+        .values(comment_count=discussion.c.comment_count + delta, updated_at=discussion.c.updated_at)
+    )
+
+
+@event.listens_for(Comment, 'after_insert')
+def _comment_inserted(mapper, connection, target):
+    _adjust_comment_count(connection, target.discussion_id, 1)
+
+
+@event.listens_for(Comment, 'after_delete')
+def _comment_deleted(mapper, connection, target):
+    _adjust_comment_count(connection, target.discussion_id, -1)
+
+
 class Certificate(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     student_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=False)
-    issued_date = db.Column(db.DateTime, default=datetime.utcnow)
+    issued_date = db.Column(db.DateTime, default=datetime.utcnow, server_default=func.now())
     certificate_id = db.Column(db.String(50), unique=True, nullable=False)
     is_verified = db.Column(db.Boolean, default=True)
     instructor_notes = db.Column(db.Text, nullable=True)
@@ -451,8 +821,84 @@ class Certificate(db.Model):
         
     def generate_certificate_id(self):
         """Generate a unique certificate ID"""
-        import uuid
-        import time
-        timestamp = int(time.time())
-        unique_id = str(uuid.uuid4().hex)[:8]
-        return f"CERT-{self.course_id}-{self.student_id}-{timestamp}-{unique_id}"
+        issued = self.issued_date or datetime.utcnow()
+        return _certificate_id(self.course_id, self.student_id, issued)
+
+    @classmethod
+    def bulk_issue(cls, pairs, instructor_notes=None):
+        """Issue certificates for (student_id, course_id) pairs with one INSERT (the caller commits)"""
+        now = datetime.utcnow()
+        rows = [
+            {
+                'student_id': student_id,
+                'course_id': course_id,
+                'issued_date': now,
+                'certificate_id': _certificate_id(course_id, student_id, now),
+                'instructor_notes': instructor_notes,
+            }
+            for student_id, course_id in pairs
+        ]
+        if rows:
+            db.session.execute(insert(cls), rows)
+        return [row['certificate_id'] for row in rows]
+
+
+def _certificate_id(course_id, student_id, issued):
+    """Build a certificate ID from the (naive UTC) issue time plus random hex"""
+    timestamp = int(issued.replace(tzinfo=timezone.utc).timestamp())
+    return f"CERT-{course_id}-{student_id}-{timestamp}-{secrets.token_hex(4)}"
+
+
+# Home page cache invalidation: Course/Testimonial writes flag their session, and
+# the cached lists are dropped once that transaction commits (never mid-flush, so
+# a concurrent request can't re-cache pre-commit data)
+def _flag_home_content(mapper, connection, target):
+    object_session(target).info['home_content_dirty'] = True
+
+
+for _model in (Course, Testimonial):
+    for _event_name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(_model, _event_name, _flag_home_content)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_home_content(session):
+    if session.info.pop('home_content_dirty', False):
+        from utils import invalidate_home_content
+        invalidate_home_content()
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_home_content_flag(session):
+    session.info.pop('home_content_dirty', None)
+
+
+# Course analytics cache invalidation, same commit-time scheme as the home page:
+# enrollment/payment writes record their course ids on the session
+def mark_course_analytics_dirty(session, course_id):
+    """Drop a course's cached analytics once session commits; Core statements
+    that change enrollments or payment status/amount call this themselves"""
+    session.info.setdefault('analytics_dirty', set()).add(course_id)
+
+
+def _flag_course_analytics(mapper, connection, target):
+    mark_course_analytics_dirty(object_session(target), target.course_id)
+
+
+for _model in (Enrollment, Payment):
+    for _event_name in ('after_insert', 'after_update', 'after_delete'):
+        event.listen(_model, _event_name, _flag_course_analytics)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_course_analytics(session):
+    course_ids = session.info.pop('analytics_dirty', None)
+    if course_ids:
+        from utils import invalidate_course_analytics
+        for course_id in course_ids:
+            invalidate_course_analytics(course_id)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_course_analytics_flags(session):
+    session.info.pop('analytics_dirty', None)
@@ -1,28 +1,39 @@
 import os
 import logging
+import stripe
 from datetime import datetime
 from functools import wraps
-from werkzeug.utils import secure_filename
-from werkzeug.security import generate_password_hash
+from werkzeug.utils import secure_filename, safe_join
 
 from flask import (
     render_template, flash, redirect, url_for, 
-    request, abort, send_from_directory
+    request, abort, send_from_directory, make_response
 )
 from flask_login import login_user, logout_user, current_user, login_required
+from sqlalchemy import select, update, func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload, joinedload, raiseload, aliased, load_only
 
 from app import app, db
 from models import (
     User, Course, Enrollment, Content, Quiz, Question, Answer,
-    QuizAttempt, Discussion, Comment, Payment, Testimonial,
-    Notification
+    QuizAttempt, Discussion, Comment, Payment,
+    Notification, PLAN_UNLIMITED, mark_course_analytics_dirty
 )
 from forms import (
     LoginForm, RegistrationForm, CourseForm, ContentForm,
     QuizForm, QuestionForm, AnswerForm, QuizAttemptForm,
-    DiscussionForm, CommentForm, AdminUserForm
+    DiscussionForm, CommentForm, AdminUserForm,
+    invalidate_user_choices, invalidate_course_choices
 )
-from utils import save_picture, calculate_progress, allowed_file
+from utils import (
+    save_picture, calculate_progress, allowed_file, ALLOWED_CONTENT_EXT, check_login, stream_upload,
+    invalidate_unread_counts, page_arg, per_page, paginate_rows, keyset_paginate,
+    is_enrolled, invalidate_enrollment, load_course_with_enrollment, load_course_and_enrolled,
+    page_etag, not_modified, with_etag, dialect_insert
+)
+from main import get_cached_home_content
+from tasks import send_enrollment_notifications, create_stripe_session
 
 logger = logging.getLogger(__name__)
 
@@ -32,7 +43,7 @@ def register_routes(app):
     def instructor_required(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            if not current_user.is_authenticated or not current_user.is_instructor():
+            if not current_user.is_authenticated or not current_user.is_instructor:
                 flash('You need to be an instructor to access this page.', 'danger')
                 return redirect(url_for('login'))
             return f(*args, **kwargs)
@@ -42,20 +53,52 @@ def register_routes(app):
     def admin_required(f):
         @wraps(f)
         def decorated_function(*args, **kwargs):
-            if not current_user.is_authenticated or not current_user.is_admin():
+            if not current_user.is_authenticated or not current_user.is_admin:
                 flash('You need to be an admin to access this page.', 'danger')
                 return redirect(url_for('login'))
             return f(*args, **kwargs)
         return decorated_function
     
+    # Each course-owned resource's path up to its Course, as (parent, foreign key) joins
+    OWNERSHIP_PATHS = {
+        Course: (),
+        Content: ((Course, Content.course_id),),
+        Quiz: ((Course, Quiz.course_id),),
+        Question: ((Quiz, Question.quiz_id), (Course, Quiz.course_id)),
+        Answer: ((Question, Answer.question_id), (Quiz, Question.quiz_id), (Course, Quiz.course_id)),
+    }
+    
+    # Decorator that loads a course-owned resource and its parents in one JOINed
+    # query, checks the current instructor created the course, and passes the
+    # rows to the view as keyword arguments (course, quiz, question, ...)
+    def owned_by_instructor(model, message):
+        param = f'{model.__name__.lower()}_id'
+        path = OWNERSHIP_PATHS[model]
+        
+        def decorator(f):
+            @wraps(f)
+            def decorated_function(*args, **kwargs):
+                stmt = select(model, *(parent for parent, _ in path))
+                for parent, foreign_key in path:
+                    stmt = stmt.join(parent, parent.id == foreign_key)
+                row = db.session.execute(stmt.where(model.id == kwargs.pop(param))).first()
+                if row is None:
+                    abort(404)
+                if row[-1].instructor_id != current_user.id:
+                    flash(message, 'danger')
+                    abort(403)
+                kwargs.update((type(obj).__name__.lower(), obj) for obj in row)
+                return f(*args, **kwargs)
+            return decorated_function
+        return decorator
+    
     # Home route
     @app.route('/')
     def home():
-        # Get popular courses sorted by rating (highest first)
-        popular_courses = Course.query.filter_by(is_published=True).order_by(Course.rating.desc(), Course.id.desc()).limit(6).all()
-        # Get approved testimonials for the homepage
-        testimonials = Testimonial.query.filter_by(is_approved=True).order_by(Testimonial.created_at.desc()).limit(3).all()
-        return render_template('home.html', courses=popular_courses, testimonials=testimonials)
+        # Popular courses and approved testimonials, served from the cache
+        popular_courses, testimonials = get_cached_home_content()
+        # This page has always shown three testimonials (the cache holds six for main.home)
+        return render_template('home.html', courses=popular_courses, testimonials=testimonials[:3])
     
     # Auth routes
     @app.route('/login', methods=['GET', 'POST'])
@@ -66,15 +109,19 @@ def register_routes(app):
         form = LoginForm()
         if form.validate_on_submit():
             user = User.query.filter_by(email=form.email.data).first()
-            if user and user.check_password(form.password.data):
+            # Only the login view verifies passwords; later requests ride on the session
+            if user and check_login(user, form.password.data):
+                if db.session.is_modified(user):
+                    # check_password upgraded a legacy hash
+                    db.session.commit()
                 login_user(user)
                 next_page = request.args.get('next')
                 flash('Login successful!', 'success')
                 
                 # Redirect to appropriate dashboard based on role
-                if user.is_admin():
+                if user.is_admin:
                     return redirect(url_for('admin_dashboard'))
-                elif user.is_instructor():
+                elif user.is_instructor:
                     return redirect(url_for('instructor_dashboard'))
                 else:
                     return redirect(url_for('student_dashboard'))
@@ -90,15 +137,20 @@ def register_routes(app):
         
         form = RegistrationForm()
         if form.validate_on_submit():
-            hashed_password = generate_password_hash(form.password.data)
+            # Release the connection used by the uniqueness checks before hashing,
+            # so no transaction stays open while the KDF runs
+            db.session.close()
+            
             user = User(
                 username=form.username.data,
                 email=form.email.data,
-                password_hash=hashed_password,
                 role=form.role.data
             )
+            # Pinned scrypt cost (models.PASSWORD_HASH_METHOD), same as every other path
+            user.set_password(form.password.data)
             db.session.add(user)
             db.session.commit()
+            invalidate_user_choices()
             flash('Your account has been created! You can now log in.', 'success')
             return redirect(url_for('login'))
         
@@ -110,48 +162,17 @@ def register_routes(app):
         flash('You have been logged out.', 'info')
         return redirect(url_for('main.home'))
     
-    # Course discussion routes
-    @app.route('/courses/<int:course_id>/discussions')
-    def course_discussions(course_id):
-        course = Course.query.get_or_404(course_id)
-        discussions = Discussion.query.filter_by(course_id=course_id).order_by(Discussion.created_at.desc()).all()
-        return render_template('courses/discussions.html', course=course, discussions=discussions)
+    # Legacy forum URLs, permanently redirected to the canonical discussion routes
+    @app.route('/forum/thread/<int:thread_id>')
+    def legacy_view_thread(thread_id):
+        return redirect(url_for('view_thread', thread_id=thread_id), code=301)
     
-    @app.route('/forum/thread/<int:thread_id>', methods=['GET'])
-    def view_thread(thread_id):
-        """View a specific forum thread"""
-        thread = Discussion.query.get_or_404(thread_id)
-        course = Course.query.get_or_404(thread.course_id)
-        form = CommentForm()
-        
-        # Update view count
-        thread.views += 1
-        db.session.commit()
-        
-        # Get all comments for this thread
-        comments = Comment.query.filter_by(discussion_id=thread.id).order_by(Comment.created_at.asc()).all()
-        
-        return render_template('forum/view.html', thread=thread, comments=comments, form=form, course=course)
-    
-    @app.route('/forum/new', methods=['GET', 'POST'])
-    @login_required
-    def new_thread():
-        """Create a new forum thread"""
-        course_id = request.args.get('course_id')
-        course = Course.query.get_or_404(course_id)
-        form = DiscussionForm()
-        if form.validate_on_submit():
-            discussion = Discussion(
-                course_id=course.id,
-                author_id=current_user.id,
-                title=form.title.data,
-                content=form.content.data
-            )
-            db.session.add(discussion)
-            db.session.commit()
-            flash('Your thread has been created!', 'success')
-            return redirect(url_for('view_thread', thread_id=discussion.id))
-        return render_template('forum/create.html', form=form, course=course)
+    @app.route('/forum/new')
+    def legacy_new_thread():
+        course_id = request.args.get('course_id', type=int)
+        if course_id is None:
+            abort(404)
+        return redirect(url_for('course_discussions', course_id=course_id), code=301)
     
     @app.route('/forum/thread/<int:thread_id>/comment', methods=['POST'])
     @login_required
@@ -166,19 +187,24 @@ def register_routes(app):
                 discussion_id=thread.id,
                 author_id=current_user.id
             )
-            db.session.add(comment)
-            db.session.commit()
+            new_rows = [comment]
             
             # Create a notification for the thread creator if it's not the same user
-            if thread.author_id != current_user.id:
-                notification = Notification(
+            notify_author = thread.author_id != current_user.id
+            if notify_author:
+                new_rows.append(Notification(
                     user_id=thread.author_id,
                     title="New Comment on Your Thread",
                     message=f"{current_user.username} commented on your thread '{thread.title}'",
                     notification_type='forum_comment',
                     related_id=thread.id
-                )
-                db.session.add(notification)
+                ))
+            
+            # Comment and notification are written in one flush and one commit
+            db.session.add_all(new_rows)
+            db.session.commit()
+            if notify_author:
+                invalidate_unread_counts(thread.author_id)
             
             flash('Your comment has been added!', 'success')
         return redirect(url_for('view_thread', thread_id=thread.id))
@@ -191,7 +217,7 @@ def register_routes(app):
         thread_id = comment.discussion_id
         
         # Ensure only the comment author or admin can delete it
-        if comment.author_id != current_user.id and not current_user.is_admin():
+        if comment.author_id != current_user.id and not current_user.is_admin:
             abort(403)
         
         db.session.delete(comment)
@@ -208,7 +234,7 @@ def register_routes(app):
         thread = Discussion.query.get_or_404(comment.discussion_id)
         
         # Ensure only the comment author or admin can edit it
-        if comment.author_id != current_user.id and not current_user.is_admin():
+        if comment.author_id != current_user.id and not current_user.is_admin:
             abort(403)
         
         form = CommentForm()
@@ -229,7 +255,7 @@ def register_routes(app):
         """Edit a forum thread"""
         thread = Discussion.query.get_or_404(thread_id)
         course = Course.query.get_or_404(thread.course_id)
-        if thread.author_id != current_user.id and not current_user.is_admin():
+        if thread.author_id != current_user.id and not current_user.is_admin:
             abort(403)
         
         form = DiscussionForm()
@@ -251,42 +277,83 @@ def register_routes(app):
     def delete_thread(thread_id):
         """Delete a forum thread"""
         thread = Discussion.query.get_or_404(thread_id)
-        course = Course.query.get_or_404(thread.course_id)
+        course_id = thread.course_id
         
         # Ensure only the thread author or admin can delete it
-        if thread.author_id != current_user.id and not current_user.is_admin():
+        if thread.author_id != current_user.id and not current_user.is_admin:
             abort(403)
         
-        # Delete all comments associated with this thread
-        Comment.query.filter_by(discussion_id=thread.id).delete()
-        
-        # Delete the thread
-        db.session.delete(thread)
+        # Set-based deletes: comments are never loaded into the session
+        # (the FK also cascades where the database enforces it)
+        Comment.query.filter_by(discussion_id=thread.id).delete(synchronize_session=False)
+        Discussion.query.filter_by(id=thread.id).delete(synchronize_session=False)
         db.session.commit()
         
         flash('Your thread has been deleted!', 'success')
-        return redirect(url_for('course_discussions', course_id=course.id))
+        return redirect(url_for('course_discussions', course_id=course_id))
     
     # Dashboard routes
+    DASHBOARD_COURSE_COLUMNS = (
+        Course.id, Course.title, Course.thumbnail, Course.price, Course.is_published,
+        Course.rating, Course.enrollment_count, Course.created_at
+    )
+    
     @app.route('/dashboard/student')
     @login_required
     def student_dashboard():
-        enrollments = Enrollment.query.filter_by(student_id=current_user.id).all()
-        return render_template('dashboard/student.html', enrollments=enrollments)
+        # Courses (and their instructors) for every enrollment in one extra query
+        pagination = Enrollment.query.options(
+            selectinload(Enrollment.course).joinedload(Course.instructor)
+        ).filter_by(student_id=current_user.id).order_by(
+            Enrollment.enrolled_at.desc(), Enrollment.id.desc()
+        ).paginate(page=page_arg(), per_page=per_page(), error_out=False)
+        return render_template('dashboard/student.html', enrollments=pagination.items,
+                               pagination=pagination)
     
     @app.route('/dashboard/instructor')
     @instructor_required
     def instructor_dashboard():
-        courses = Course.query.filter_by(instructor_id=current_user.id).all()
-        return render_template('dashboard/instructor.html', courses=courses)
+        # Lightweight rows with just the columns the dashboard lists
+        page = paginate_rows(
+            select(*DASHBOARD_COURSE_COLUMNS)
+            .where(Course.instructor_id == current_user.id)
+            .order_by(Course.created_at.desc(), Course.id.desc())
+        )
+        return render_template('dashboard/instructor.html', courses=page.items, pagination=page)
     
     @app.route('/dashboard/admin')
     @admin_required
     def admin_dashboard():
-        users = User.query.all()
-        courses = Course.query.all()
-        payments = Payment.query.all()
-        return render_template('dashboard/admin.html', users=users, courses=courses, payments=payments)
+        # Plain rows instead of hydrated ORM objects; instructor/user/course names
+        # are joined in, and per-course enrollment totals are the denormalized
+        # Course.enrollment_count column
+        # Each list pages independently (?users_cursor=, ?courses_cursor=, ?payments_cursor=)
+        users = keyset_paginate(
+            select(User.id, User.username, User.email, User.role, User.is_approved, User.created_at),
+            User.created_at, User.id, cursor_param='users_cursor'
+        )
+        courses = keyset_paginate(
+            select(*DASHBOARD_COURSE_COLUMNS, User.username.label('instructor_name'))
+            .join(User, User.id == Course.instructor_id),
+            Course.created_at, Course.id, cursor_param='courses_cursor'
+        )
+        payments = keyset_paginate(
+            select(
+                Payment.id, Payment.amount, Payment.payment_method, Payment.status, Payment.created_at,
+                User.username.label('username'), Course.title.label('course_title')
+            )
+            .join(User, User.id == Payment.user_id)
+            .join(Course, Course.id == Payment.course_id),
+            Payment.created_at, Payment.id, cursor_param='payments_cursor'
+        )
+        role_counts = dict(db.session.execute(
+            select(User.role, func.count()).group_by(User.role)
+        ).all())
+        return render_template('dashboard/admin.html', users=users.items, courses=courses.items,
+                               payments=payments.items, role_counts=role_counts,
+                               users_next_cursor=users.next_cursor,
+                               courses_next_cursor=courses.next_cursor,
+                               payments_next_cursor=payments.next_cursor)
     
     # Course routes
     @app.route('/courses')
@@ -297,7 +364,7 @@ def register_routes(app):
     @instructor_required
     def create_course():
         # Ensure only instructors can create courses (admin cannot create courses)
-        if not current_user.is_instructor():
+        if not current_user.is_instructor:
             flash('Only instructors can create courses.', 'danger')
             return redirect(url_for('course.list_courses'))
             
@@ -322,6 +389,7 @@ def register_routes(app):
             )
             db.session.add(course)
             db.session.commit()
+            invalidate_course_choices()
             
             if price == 0:
                 flash('Free course created successfully!', 'success')
@@ -334,13 +402,9 @@ def register_routes(app):
     
     @app.route('/courses/<int:course_id>/edit', methods=['GET', 'POST'])
     @instructor_required
-    def edit_course(course_id):
-        course = Course.query.get_or_404(course_id)
-        # Only the instructor who created the course can edit it (admin cannot edit)
-        if course.instructor_id != current_user.id:
-            flash('You can only edit courses you have created.', 'danger')
-            abort(403)
-        
+    # Only the instructor who created the course can edit it (admin cannot edit)
+    @owned_by_instructor(Course, 'You can only edit courses you have created.')
+    def edit_course(course):
         form = CourseForm()
         if form.validate_on_submit():
             course.title = form.title.data
@@ -354,6 +418,7 @@ def register_routes(app):
                 course.thumbnail = thumbnail_filename
             
             db.session.commit()
+            invalidate_course_choices()
             
             if course.price == 0:
                 flash('Free course updated successfully!', 'success')
@@ -374,10 +439,7 @@ def register_routes(app):
         course = Course.query.get_or_404(course_id)
         is_enrolled = False
         if current_user.is_authenticated:
-            enrollment = Enrollment.query.filter_by(
-                student_id=current_user.id, 
-                course_id=course.id
-            ).first()
+            enrollment = Enrollment.find(current_user.id, course.id)
             is_enrolled = enrollment is not None
         
         return render_template('courses/view.html', course=course, is_enrolled=is_enrolled)
@@ -385,12 +447,7 @@ def register_routes(app):
     @app.route('/courses/<int:course_id>/enroll')
     @login_required
     def enroll_course(course_id):
-        course = Course.query.get_or_404(course_id)
-        # Check if already enrolled
-        enrollment = Enrollment.query.filter_by(
-            student_id=current_user.id, 
-            course_id=course.id
-        ).first()
+        course, enrollment = load_course_with_enrollment(course_id, current_user.id)
         
         # If enrollment exists but expired, redirect to renewal page
         if enrollment and enrollment.is_expired():
@@ -407,58 +464,50 @@ def register_routes(app):
             enrollment = Enrollment(
                 student_id=current_user.id,
                 course_id=course.id,
-                subscription_type='unlimited',
+                plan_id=PLAN_UNLIMITED,
                 expires_at=None,
                 is_active=True
             )
-            db.session.add(enrollment)
             
-            # Notify student and instructor
-            notification = Notification(
-                user_id=current_user.id,
-                title='Course Enrollment',
-                message=f'You have successfully enrolled in {course.title}.',
-                notification_type='enrollment',
-                related_id=course.id
-            )
-            db.session.add(notification)
+            course_id = course.id
             
-            instructor_notification = Notification(
-                user_id=course.instructor_id,
-                title='New Student Enrollment',
-                message=f'{current_user.username} has enrolled in your course {course.title}.',
-                notification_type='enrollment',
-                related_id=course.id
-            )
-            db.session.add(instructor_notification)
+            # The request only writes the enrollment
+            try:
+                db.session.add(enrollment)
+                db.session.commit()
+                invalidate_enrollment(current_user.id, course_id)
+            except IntegrityError:
+                # A concurrent request enrolled first (unique student/course index)
+                db.session.rollback()
+                flash('You are already enrolled in this course.', 'info')
+                return redirect(url_for('view_course', course_id=course_id))
             
-            db.session.commit()
+            # Student and instructor notifications are written by a background job
+            send_enrollment_notifications.delay(current_user.id, course_id)
             flash('You have been enrolled in the course!', 'success')
-            return redirect(url_for('view_course', course_id=course.id))
+            return redirect(url_for('view_course', course_id=course_id))
         else:
             # Redirect to payment page for paid courses
             return redirect(url_for('checkout', course_id=course.id))
     
     # Content management routes
+    @app.route('/courses/<int:course_id>/manage-content')
+    def legacy_manage_content(course_id):
+        return redirect(url_for('manage_content', course_id=course_id), code=301)
+    
     @app.route('/courses/<int:course_id>/content', methods=['GET', 'POST'])
-    @app.route('/courses/<int:course_id>/manage-content', methods=['GET', 'POST'])
     @instructor_required
-    def manage_content(course_id):
-        course = Course.query.get_or_404(course_id)
-        # Only the instructor who created the course can manage its content
-        if course.instructor_id != current_user.id:
-            flash('You can only manage content for courses you have created.', 'danger')
-            abort(403)
-        
+    @owned_by_instructor(Course, 'You can only manage content for courses you have created.')
+    def manage_content(course):
         form = ContentForm()
         if form.validate_on_submit():
             file_path = None
             if form.content_type.data in ['video', 'pdf'] and form.file.data:
                 file = form.file.data
-                if allowed_file(file.filename, ['mp4', 'pdf']):
+                if allowed_file(file.filename, ALLOWED_CONTENT_EXT):
                     filename = secure_filename(file.filename)
                     file_path = os.path.join('static/uploads/content', filename)
-                    file.save(file_path)
+                    stream_upload(file, file_path)
             
             content = Content(
                 course_id=course.id,
@@ -478,18 +527,16 @@ def register_routes(app):
     
     @app.route('/content/<int:content_id>/delete', methods=['POST'])
     @instructor_required
-    def delete_content(content_id):
-        content = Content.query.get_or_404(content_id)
-        course = Course.query.get_or_404(content.course_id)
-        
-        # Only the instructor who created the course can delete its content
-        if course.instructor_id != current_user.id:
-            flash('You can only delete content for courses you have created.', 'danger')
-            abort(403)
-        
-        # Delete file if exists
-        if content.file_path and os.path.exists(content.file_path):
-            os.remove(content.file_path)
+    @owned_by_instructor(Content, 'You can only delete content for courses you have created.')
+    def delete_content(content, course):
+        # Delete file if exists (a single unlink, no separate exists() check)
+        if content.file_path:
+            try:
+                os.unlink(content.file_path)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                logger.exception("Failed to remove content file %s", content.file_path)
         
         db.session.delete(content)
         db.session.commit()
@@ -499,13 +546,8 @@ def register_routes(app):
     # Quiz routes
     @app.route('/courses/<int:course_id>/quizzes', methods=['GET', 'POST'])
     @instructor_required
-    def manage_quizzes(course_id):
-        course = Course.query.get_or_404(course_id)
-        # Only the instructor who created the course can manage its quizzes
-        if course.instructor_id != current_user.id:
-            flash('You can only manage quizzes for courses you have created.', 'danger')
-            abort(403)
-        
+    @owned_by_instructor(Course, 'You can only manage quizzes for courses you have created.')
+    def manage_quizzes(course):
         form = QuizForm()
         if form.validate_on_submit():
             quiz = Quiz(
@@ -525,15 +567,8 @@ def register_routes(app):
     
     @app.route('/quizzes/<int:quiz_id>/edit', methods=['GET', 'POST'])
     @instructor_required
-    def edit_quiz(quiz_id):
-        quiz = Quiz.query.get_or_404(quiz_id)
-        course = Course.query.get_or_404(quiz.course_id)
-        
-        # Only the instructor who created the course can edit quizzes
-        if course.instructor_id != current_user.id:
-            flash('You can only edit quizzes for courses you have created.', 'danger')
-            abort(403)
-        
+    @owned_by_instructor(Quiz, 'You can only edit quizzes for courses you have created.')
+    def edit_quiz(quiz, course):
         form = QuestionForm()
         if form.validate_on_submit():
             question = Question(
@@ -555,21 +590,24 @@ def register_routes(app):
             flash('Question added successfully!', 'success')
             return redirect(url_for('edit_question', question_id=question.id))
         
-        questions = Question.query.filter_by(quiz_id=quiz.id).all()
-        return render_template('courses/quiz.html', quiz=quiz, form=form, questions=questions, course=course)
+        # Questions with their answer counts in one grouped query; the template
+        # still gets Question objects, with the counts keyed by question id
+        rows = db.session.execute(
+            select(Question, func.count(Answer.id).label('answer_count'))
+            .outerjoin(Answer, Answer.question_id == Question.id)
+            .where(Question.quiz_id == quiz.id)
+            .group_by(Question.id)
+            .order_by(Question.id)
+        ).all()
+        questions = [question for question, _ in rows]
+        answer_counts = {question.id: count for question, count in rows}
+        return render_template('courses/quiz.html', quiz=quiz, form=form, questions=questions,
+                               answer_counts=answer_counts, course=course)
     
     @app.route('/questions/<int:question_id>/edit', methods=['GET', 'POST'])
     @instructor_required
-    def edit_question(question_id):
-        question = Question.query.get_or_404(question_id)
-        quiz = Quiz.query.get_or_404(question.quiz_id)
-        course = Course.query.get_or_404(quiz.course_id)
-        
-        # Only the instructor who created the course can edit quiz questions
-        if course.instructor_id != current_user.id:
-            flash('You can only edit questions for courses you have created.', 'danger')
-            abort(403)
-        
+    @owned_by_instructor(Question, 'You can only edit questions for courses you have created.')
+    def edit_question(question, quiz, course):
         form = AnswerForm()
         if form.validate_on_submit() and question.question_type != 'short_answer':
             answer = Answer(
@@ -588,17 +626,9 @@ def register_routes(app):
     
     @app.route('/questions/<int:question_id>/delete', methods=['POST'])
     @instructor_required
-    def delete_question(question_id):
-        question = Question.query.get_or_404(question_id)
-        quiz_id = question.quiz_id
-        quiz = Quiz.query.get_or_404(quiz_id)
-        course = Course.query.get_or_404(quiz.course_id)
-        
-        # Only the instructor who created the course can delete quiz questions
-        if course.instructor_id != current_user.id:
-            flash('You can only delete questions for courses you have created.', 'danger')
-            abort(403)
-        
+    @owned_by_instructor(Question, 'You can only delete questions for courses you have created.')
+    def delete_question(question, quiz, course):
+        quiz_id = quiz.id
         db.session.delete(question)
         db.session.commit()
         flash('Question deleted successfully!', 'success')
@@ -606,18 +636,9 @@ def register_routes(app):
     
     @app.route('/answers/<int:answer_id>/delete', methods=['POST'])
     @instructor_required
-    def delete_answer(answer_id):
-        answer = Answer.query.get_or_404(answer_id)
-        question_id = answer.question_id
-        question = Question.query.get_or_404(question_id)
-        quiz = Quiz.query.get_or_404(question.quiz_id)
-        course = Course.query.get_or_404(quiz.course_id)
-        
-        # Only the instructor who created the course can delete quiz answers
-        if course.instructor_id != current_user.id:
-            flash('You can only delete answers for courses you have created.', 'danger')
-            abort(403)
-        
+    @owned_by_instructor(Answer, 'You can only delete answers for courses you have created.')
+    def delete_answer(answer, question, quiz, course):
+        question_id = question.id
         db.session.delete(answer)
         db.session.commit()
         flash('Answer deleted successfully!', 'success')
@@ -630,12 +651,9 @@ def register_routes(app):
         course = Course.query.get_or_404(quiz.course_id)
         
         # Check if user is enrolled
-        enrollment = Enrollment.query.filter_by(
-            student_id=current_user.id, 
-            course_id=course.id
-        ).first()
+        enrollment = Enrollment.find(current_user.id, course.id)
         
-        if not enrollment and not current_user.is_instructor():
+        if not enrollment and not current_user.is_instructor:
             flash('You need to be enrolled in this course to take the quiz.', 'warning')
             return redirect(url_for('view_course', course_id=course.id))
         
@@ -660,24 +678,25 @@ def register_routes(app):
             db.session.commit()
         
         form = QuizAttemptForm()
-        questions = Question.query.filter_by(quiz_id=quiz.id).all()
+        questions = Question.query.options(selectinload(Question.answers)).filter_by(quiz_id=quiz.id).all()
         
         if form.validate_on_submit():
             score = 0
             total_points = sum(q.points for q in questions)
             
+            # Answer keys from the already-loaded answers, so grading runs no queries
+            correct_map = {q.id: {str(a.id) for a in q.answers if a.is_correct} for q in questions}
+            tf_correct = {q.id: next((a.text for a in q.answers if a.is_correct), None) for q in questions}
+            
             for question in questions:
                 # Get submitted answer for the question
                 if question.question_type == 'multiple_choice':
                     selected_answer_id = request.form.get(f'question_{question.id}')
-                    if selected_answer_id:
-                        selected_answer = Answer.query.get(selected_answer_id)
-                        if selected_answer and selected_answer.is_correct:
-                            score += question.points
+                    if selected_answer_id in correct_map[question.id]:
+                        score += question.points
                 elif question.question_type == 'true_false':
                     selected_value = request.form.get(f'question_{question.id}')
-                    correct_value = next((a.text for a in question.answers if a.is_correct), None)
-                    if selected_value == correct_value:
+                    if selected_value == tf_correct[question.id]:
                         score += question.points
                 elif question.question_type == 'short_answer':
                     # For simplicity, we're assuming the instructor would manually grade these
@@ -705,37 +724,52 @@ def register_routes(app):
     @app.route('/courses/<int:course_id>/discussions')
     @login_required
     def course_discussions(course_id):
-        course = Course.query.get_or_404(course_id)
+        course, enrolled = load_course_and_enrolled(course_id, current_user.id)
         
         # Check if user is enrolled or is instructor/admin
-        if not current_user.is_instructor():
-            enrollment = Enrollment.query.filter_by(
-                student_id=current_user.id, 
-                course_id=course.id
-            ).first()
-            
-            if not enrollment:
+        if not current_user.is_instructor:
+            if not enrolled:
                 flash('You need to be enrolled in this course to access discussions.', 'warning')
                 return redirect(url_for('view_course', course_id=course.id))
         
-        discussions = Discussion.query.filter_by(course_id=course.id).order_by(Discussion.created_at.desc()).all()
+        # Answer repeat views with 304 until a discussion is added, edited or removed,
+        # or the listed comment/view counts move (those don't touch updated_at)
+        version = db.session.execute(
+            select(
+                func.max(Discussion.updated_at), func.count(Discussion.id),
+                func.sum(Discussion.comment_count), func.sum(Discussion.views)
+            )
+            .where(Discussion.course_id == course.id)
+        ).one()
+        etag = page_etag(course.updated_at, *version)
+        cached = not_modified(etag)
+        if cached:
+            return cached
+        
+        # The list only shows titles, so skip the (large) content column; the
+        # author's name comes in the same query
+        pagination = keyset_paginate(
+            select(Discussion).options(
+                load_only(Discussion.id, Discussion.course_id, Discussion.title,
+                          Discussion.author_id, Discussion.created_at, Discussion.views,
+                          Discussion.comment_count),
+                joinedload(Discussion.author).load_only(User.id, User.username)
+            ).where(Discussion.course_id == course.id),
+            Discussion.created_at, Discussion.id, scalars=True
+        )
         form = DiscussionForm()
         
-        return render_template('forum/index.html', course=course, discussions=discussions, form=form)
+        return with_etag(render_template('forum/index.html', course=course, discussions=pagination.items,
+                                         pagination=pagination, form=form), etag)
     
     @app.route('/courses/<int:course_id>/discussions/create', methods=['POST'])
     @login_required
     def new_thread(course_id):
-        course = Course.query.get_or_404(course_id)
+        course, enrolled = load_course_and_enrolled(course_id, current_user.id)
         
         # Check if user is enrolled or is instructor/admin
-        if not current_user.is_instructor():
-            enrollment = Enrollment.query.filter_by(
-                student_id=current_user.id, 
-                course_id=course.id
-            ).first()
-            
-            if not enrollment:
+        if not current_user.is_instructor:
+            if not enrolled:
                 flash('You need to be enrolled in this course to create discussions.', 'warning')
                 return redirect(url_for('view_course', course_id=course.id))
         
@@ -748,7 +782,21 @@ def register_routes(app):
                 content=form.content.data
             )
             db.session.add(discussion)
+            
+            # Let the instructor know, committed together with the thread
+            notify_instructor = course.instructor_id != current_user.id
+            if notify_instructor:
+                db.session.flush()  # assigns discussion.id for the notification
+                db.session.add(Notification(
+                    user_id=course.instructor_id,
+                    title="New Discussion in Your Course",
+                    message=f"{current_user.username} started a discussion '{discussion.title}' in {course.title}",
+                    notification_type='forum_thread',
+                    related_id=discussion.id
+                ))
             db.session.commit()
+            if notify_instructor:
+                invalidate_unread_counts(course.instructor_id)
             flash('Discussion created successfully!', 'success')
         
         return redirect(url_for('course_discussions', course_id=course.id))
@@ -756,20 +804,27 @@ def register_routes(app):
     @app.route('/discussions/<int:thread_id>', methods=['GET', 'POST'])
     @login_required
     def view_thread(thread_id):
-        discussion = Discussion.query.get_or_404(thread_id)
-        course = Course.query.get_or_404(discussion.course_id)
+        discussion = Discussion.query.options(joinedload(Discussion.course)).get_or_404(thread_id)
+        course = discussion.course
         
         # Check if user is enrolled or is instructor/admin
-        if not current_user.is_instructor():
-            enrollment = Enrollment.query.filter_by(
-                student_id=current_user.id, 
-                course_id=course.id
-            ).first()
-            
-            if not enrollment:
+        if not current_user.is_instructor:
+            if not is_enrolled(current_user.id, course.id):
                 flash('You need to be enrolled in this course to view discussions.', 'warning')
                 return redirect(url_for('view_course', course_id=course.id))
         
+        if request.method == 'GET':
+            # Bump the view count atomically in SQL (no read-modify-write race);
+            # 'evaluate' applies the +1 to the loaded thread so the page shows it.
+            # updated_at is pinned so a view doesn't count as an edit
+            db.session.execute(
+                update(Discussion)
+                .where(Discussion.id == discussion.id)
+                .values(views=Discussion.views + 1, updated_at=Discussion.updated_at)
+                .execution_options(synchronize_session='evaluate')
+            )
+            db.session.commit()
+        
         form = CommentForm()
         if form.validate_on_submit():
             comment = Comment(
@@ -782,24 +837,27 @@ def register_routes(app):
             flash('Comment added successfully!', 'success')
             return redirect(url_for('view_thread', thread_id=discussion.id))
         
-        comments = Comment.query.filter_by(discussion_id=discussion.id).order_by(Comment.created_at).all()
+        # One page of comments, oldest first, continuing after ?after=
+        comments = keyset_paginate(
+            select(Comment).options(joinedload(Comment.author))
+            .where(Comment.discussion_id == discussion.id),
+            Comment.created_at, Comment.id,
+            cursor_param='after', scalars=True, oldest_first=True
+        )
         
         return render_template('forum/topic.html', discussion=discussion, 
-                              comments=comments, form=form, course=course)
+                              comments=comments.items, next_after=comments.next_cursor,
+                              form=form, course=course)
     
     # Payment routes
     @app.route('/courses/<int:course_id>/checkout')
     @login_required
     def checkout(course_id):
-        course = Course.query.get_or_404(course_id)
+        # Course and whether the student is enrolled, in a single query
+        course, enrolled = load_course_and_enrolled(course_id, current_user.id)
         
         # Check if already enrolled
-        enrollment = Enrollment.query.filter_by(
-            student_id=current_user.id, 
-            course_id=course.id
-        ).first()
-        
-        if enrollment:
+        if enrolled:
             flash('You are already enrolled in this course.', 'info')
             return redirect(url_for('view_course', course_id=course.id))
         
@@ -813,76 +871,85 @@ def register_routes(app):
         # Set the domain to use for redirection
         YOUR_DOMAIN = request.host_url.rstrip('/')
         
-        try:
-            # Create a Stripe checkout session
-            checkout_session = stripe.checkout.Session.create(
-                payment_method_types=['card'],
-                line_items=[
-                    {
-                        'price_data': {
-                            'currency': 'usd',
-                            'product_data': {
-                                'name': course.title,
-                                'description': course.description[:100] + '...' if len(course.description) > 100 else course.description,
-                            },
-                            'unit_amount': int(course.price * 100),  # Stripe requires amount in cents
-                        },
-                        'quantity': 1,
-                    },
-                ],
-                mode='payment',
-                success_url=YOUR_DOMAIN + url_for('payment_success', course_id=course.id),
-                cancel_url=YOUR_DOMAIN + url_for('payment_cancel', course_id=course.id),
-                metadata={
-                    'course_id': course.id,
-                    'user_id': current_user.id
-                }
-            )
-            
-            # Create a pending payment record
-            payment = Payment(
-                user_id=current_user.id,
-                course_id=course.id,
-                amount=course.price,
-                payment_id=checkout_session.id,
-                status='pending'
-            )
-            db.session.add(payment)
-            db.session.commit()
-            
-            return redirect(checkout_session.url, code=303)
-        except Exception as e:
-            logger.error(f"Error creating checkout session: {str(e)}")
+        # Record the payment now; the Stripe API call runs in a background task so
+        # the worker isn't held for it, and the status page polls until it's done
+        payment = Payment(
+            user_id=current_user.id,
+            course_id=course.id,
+            amount=course.price,
+            payment_method='stripe',
+            status='initiating'
+        )
+        db.session.add(payment)
+        db.session.commit()
+        
+        create_stripe_session.delay(
+            payment.id,
+            YOUR_DOMAIN + url_for('payment_success', course_id=course.id),
+            YOUR_DOMAIN + url_for('payment_cancel', course_id=course.id)
+        )
+        return redirect(url_for('payment_status', payment_id=payment.id), code=303)
+    
+    @app.route('/payment/status/<int:payment_id>')
+    @login_required
+    def payment_status(payment_id):
+        payment = db.session.execute(
+            select(Payment.status, Payment.course_id, Payment.details)
+            .where(Payment.id == payment_id, Payment.user_id == current_user.id)
+        ).first()
+        if payment is None:
+            abort(404)
+        
+        if payment.status == 'initiating':
+            # Still waiting on Stripe; the Refresh header makes the browser poll.
+            # A plain body keeps this path independent of any template
+            return 'Preparing your checkout, please wait...', 202, {
+                'Refresh': '1',
+                'Content-Type': 'text/plain; charset=utf-8',
+                'Cache-Control': 'no-store'
+            }
+        
+        checkout_url = (payment.details or {}).get('checkout_url')
+        if payment.status == 'pending' and checkout_url:
+            return redirect(checkout_url, code=303)
+        
+        if payment.status == 'failed':
             flash('An error occurred while processing your payment.', 'danger')
-            return redirect(url_for('view_course', course_id=course.id))
+        return redirect(url_for('view_course', course_id=payment.course_id))
     
     @app.route('/payment/success/<int:course_id>')
     @login_required
     def payment_success(course_id):
-        course = Course.query.get_or_404(course_id)
-        
-        # Update payment status
-        payment = Payment.query.filter_by(
-            user_id=current_user.id,
-            course_id=course.id,
-            status='pending'
-        ).first()
-        
-        if payment:
-            payment.status = 'completed'
+        # Complete the latest pending payment in one UPDATE ... RETURNING instead of
+        # SELECT-then-UPDATE; the course itself is only needed for the template
+        pending = aliased(Payment)
+        payment_id = db.session.execute(
+            update(Payment)
+            .where(Payment.id == select(func.max(pending.id)).where(
+                pending.user_id == current_user.id,
+                pending.course_id == course_id,
+                pending.status == 'pending'
+            ).scalar_subquery())
+            .values(status='completed')
+            .returning(Payment.id)
+            .execution_options(synchronize_session=False)
+        ).scalar_one_or_none()
+        
+        if payment_id:
+            # The Core UPDATE above skips the ORM listeners; revenue changed
+            mark_course_analytics_dirty(db.session, course_id)
             
-            # Create enrollment
-            enrollment = Enrollment(
-                student_id=current_user.id,
-                course_id=course.id
-            )
-            db.session.add(enrollment)
+            # Create enrollment, committed together with the payment update; the
+            # unique student/course index makes a webhook-created one a no-op
+            Enrollment.insert_ignore(current_user.id, course_id)
             db.session.commit()
+            invalidate_enrollment(current_user.id, course_id)
             
             flash('Payment successful! You are now enrolled in the course.', 'success')
         else:
             flash('Course enrollment processed', 'info')
         
+        course = db.get_or_404(Course, course_id)
         return render_template('payment/success.html', course=course)
     
     @app.route('/payment/cancel/<int:course_id>')
@@ -890,26 +957,102 @@ def register_routes(app):
     def payment_cancel(course_id):
         course = Course.query.get_or_404(course_id)
         
-        # Update payment status to failed
-        payment = Payment.query.filter_by(
-            user_id=current_user.id,
-            course_id=course.id,
-            status='pending'
-        ).first()
-        
-        if payment:
-            payment.status = 'failed'
-            db.session.commit()
+        # Mark pending payments failed in one UPDATE (no SELECT first)
+        db.session.execute(
+            update(Payment)
+            .where(
+                Payment.user_id == current_user.id,
+                Payment.course_id == course.id,
+                Payment.status == 'pending'
+            )
+            .values(status='failed')
+            .execution_options(synchronize_session=False)
+        )
+        db.session.commit()
         
         flash('Payment was cancelled.', 'warning')
         return render_template('payment/cancel.html', course=course)
     
+    @app.route('/stripe/webhook', methods=['POST'])
+    def stripe_webhook():
+        # Stripe is the source of truth for completed checkouts: record the payment
+        # and enrollment here even if the browser never returns to payment_success
+        if not app.config['STRIPE_WEBHOOK_SECRET']:
+            # Can't verify signatures, so refuse rather than trust the payload
+            abort(503)
+        
+        try:
+            event = stripe.Webhook.construct_event(
+                request.get_data(),
+                request.headers.get('Stripe-Signature', ''),
+                app.config['STRIPE_WEBHOOK_SECRET']
+            )
+        except (ValueError, stripe.SignatureVerificationError):
+            abort(400)
+        
+        if event['type'] != 'checkout.session.completed':
+            return '', 204
+        
+        checkout_session = event['data']['object']
+        # Sessions not created by this app (Payment Links, dashboard) carry no
+        # ids; acknowledge them so Stripe doesn't keep retrying
+        metadata = checkout_session.get('metadata') or {}
+        try:
+            user_id = int(metadata.get('user_id'))
+            course_id = int(metadata.get('course_id'))
+        except (TypeError, ValueError):
+            return '', 204
+        
+        ids_exist = db.session.execute(
+            select(
+                select(User.id).where(User.id == user_id).exists(),
+                select(Course.id).where(Course.id == course_id).exists()
+            )
+        ).one()
+        if not all(ids_exist):
+            logger.warning("Stripe session %s references unknown user %s / course %s",
+                           checkout_session['id'], user_id, course_id)
+            return '', 204
+        
+        # Upsert by Stripe session id (unique ix_payment_payment_id)
+        db.session.execute(
+            dialect_insert(Payment)
+            .values(
+                user_id=user_id,
+                course_id=course_id,
+                amount=(checkout_session.get('amount_total') or 0) / 100,
+                payment_id=checkout_session['id'],
+                payment_method='stripe',
+                status='completed'
+            )
+            .on_conflict_do_update(index_elements=['payment_id'], set_={'status': 'completed'})
+        )
+        
+        # payment_success may already have enrolled the student
+        # The upsert is a Core statement, so flag the revenue change explicitly
+        # (insert_ignore only does so when it actually enrolls)
+        mark_course_analytics_dirty(db.session, course_id)
+        
+        Enrollment.insert_ignore(user_id, course_id)
+        db.session.commit()
+        invalidate_enrollment(user_id, course_id)
+        return '', 204
+    
+    # Webhook requests are authenticated by their signature, not a CSRF token
+    app.extensions['csrf'].exempt(stripe_webhook)
+    
     # Admin routes
     @app.route('/admin/users')
     @admin_required
     def admin_users():
-        users = User.query.all()
-        return render_template('dashboard/admin.html', users=users, active_tab='users')
+        # Lightweight rows with just the columns the list shows (no bio,
+        # password hash, etc.)
+        users = keyset_paginate(
+            select(User.id, User.username, User.email, User.role, User.is_approved, User.created_at),
+            User.created_at, User.id
+        )
+        return render_template('dashboard/admin.html', users=users.items,
+                               pagination=users, active_tab='users')
     
     @app.route('/admin/users/<int:user_id>/edit', methods=['GET', 'POST'])
     @admin_required
@@ -922,6 +1065,7 @@ def register_routes(app):
             user.email = form.email.data
             user.role = form.role.data
             db.session.commit()
+            invalidate_user_choices()
             flash('User updated successfully!', 'success')
             return redirect(url_for('admin_users'))
         elif request.method == 'GET':
@@ -941,20 +1085,45 @@ def register_routes(app):
         
         db.session.delete(user)
         db.session.commit()
+        invalidate_user_choices()
         flash('User deleted successfully!', 'success')
         return redirect(url_for('admin_users'))
     
     @app.route('/admin/courses')
     @admin_required
     def admin_courses():
-        courses = Course.query.all()
-        return render_template('dashboard/admin.html', courses=courses, active_tab='courses')
+        latest, total = db.session.execute(
+            select(func.max(Course.updated_at), func.count(Course.id))
+        ).one()
+        etag = page_etag(latest, total)
+        cached = not_modified(etag)
+        if cached:
+            return cached
+        
+        # Enrollment totals come from the denormalized Course.enrollment_count column
+        courses = keyset_paginate(
+            select(Course).options(
+                selectinload(Course.instructor),
+                raiseload('*', sql_only=True)
+            ),
+            Course.created_at, Course.id, scalars=True
+        )
+        return with_etag(render_template('dashboard/admin.html', courses=courses.items,
+                                         pagination=courses, active_tab='courses'), etag)
     
     @app.route('/admin/payments')
     @admin_required
     def admin_payments():
-        payments = Payment.query.all()
-        return render_template('dashboard/admin.html', payments=payments, active_tab='payments')
+        payments = keyset_paginate(
+            select(Payment).options(
+                selectinload(Payment.user),
+                selectinload(Payment.course),
+                raiseload('*', sql_only=True)
+            ),
+            Payment.created_at, Payment.id, scalars=True
+        )
+        return render_template('dashboard/admin.html', payments=payments.items,
+                               pagination=payments, active_tab='payments')
     
     # Error handlers
     @app.errorhandler(404)
@@ -972,4 +1141,16 @@ def register_routes(app):
     # Helper route for file uploads
     @app.route('/uploads/<path:filename>')
     def uploaded_file(filename):
+        accel_prefix = app.config.get('UPLOAD_ACCEL_PREFIX')
+        if accel_prefix and not app.debug:
+            # Hand the transfer to nginx (internal location aliased to UPLOAD_FOLDER)
+            # so the worker isn't tied up streaming the file
+            internal_path = safe_join(accel_prefix, filename)
+            if internal_path is None:
+                abort(404)
+            response = make_response('')
+            response.headers['X-Accel-Redirect'] = internal_path
+            # Let nginx set the type from the file extension
+            del response.headers['Content-Type']
+            return response
         return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
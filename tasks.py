@@ -0,0 +1,163 @@
+import os
+import logging
+import tempfile
+
+import stripe
+from celery import Celery, Task, shared_task
+from flask import current_app
+from sqlalchemy import select, update
+
+# Background jobs. Run a worker with `celery -A app.celery_app worker`; with no
+# CELERY_BROKER_URL configured, tasks run inline (eagerly) instead
+
+logger = logging.getLogger(__name__)
+
+def celery_init_app(app):
+    """Create the Celery app, running every task inside a Flask app context"""
+    class FlaskTask(Task):
+        def __call__(self, *args, **kwargs):
+            with app.app_context():
+                return self.run(*args, **kwargs)
+
+    celery_app = Celery(app.name, task_cls=FlaskTask)
+    celery_app.config_from_object(app.config['CELERY'])
+    celery_app.set_default()
+    app.extensions['celery'] = celery_app
+    return celery_app
+
+
+@shared_task(ignore_result=True)
+def send_enrollment_notifications(student_id, course_id):
+    """Notify a student and the course instructor about a new enrollment"""
+    from extensions import db
+    from models import User, Course
+    from utils import create_notifications_bulk
+
+    row = db.session.execute(
+        select(Course.title, Course.instructor_id, User.username)
+        .join(User, User.id == student_id)
+        .where(Course.id == course_id)
+    ).first()
+    if row is None:
+        return
+
+    create_notifications_bulk([
+        dict(
+            user_id=student_id,
+            title='Course Enrollment',
+            message=f'You have successfully enrolled in {row.title}.',
+            notification_type='enrollment',
+            related_id=course_id
+        ),
+        dict(
+            user_id=row.instructor_id,
+            title='New Student Enrollment',
+            message=f'{row.username} has enrolled in your course {row.title}.',
+            notification_type='enrollment',
+            related_id=course_id
+        ),
+    ])
+
+
+PICTURE_SIZE = (400, 400)
+
+@shared_task(ignore_result=True)
+def resize_picture(src_path, dest_path, size=PICTURE_SIZE):
+    """
+    Shrink a raw picture upload to fit size and move it to dest_path
+
+    The resized image is written to a temp file and renamed into place, so
+    dest_path never exists half-written. If resizing fails the raw upload is
+    moved to dest_path instead, so the saved filename always resolves.
+    """
+    from PIL import Image
+
+    image_format = Image.registered_extensions().get(os.path.splitext(dest_path)[1].lower())
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(dest_path), suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as out, Image.open(src_path) as i:
+            i.thumbnail(size, Image.LANCZOS)
+            if image_format == 'JPEG' and i.mode not in ('RGB', 'L'):
+                # e.g. RGBA/P content under a .jpg name
+                i = i.convert('RGB')
+            i.save(out, format=image_format, optimize=True)
+        # mkstemp creates the file as 0600; uploads are served as static files
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, dest_path)
+    except Exception:
+        logger.exception(f"Resizing {src_path} failed; keeping the original upload")
+        os.unlink(tmp_path)
+        os.chmod(src_path, 0o644)
+        os.replace(src_path, dest_path)
+    else:
+        os.unlink(src_path)
+
+STRIPE_MAX_RETRIES = 5
+
+@shared_task(bind=True, ignore_result=True, max_retries=STRIPE_MAX_RETRIES)
+def create_stripe_session(self, payment_id, success_url, cancel_url):
+    """
+    Create the Stripe checkout session for an 'initiating' payment
+
+    On success the payment becomes 'pending' with the Stripe session id and
+    details['checkout_url'] set, which the payment_status page redirects to.
+    Connection errors are retried with backoff; anything else marks it 'failed'.
+    """
+    from extensions import db
+    from models import Payment, Course
+
+    row = db.session.execute(
+        select(Payment.user_id, Course.id, Course.title, Course.description, Course.price)
+        .join(Course, Course.id == Payment.course_id)
+        .where(Payment.id == payment_id, Payment.status == 'initiating')
+    ).first()
+    if row is None:
+        return
+
+    description = row.description or ''
+    try:
+        checkout_session = stripe.checkout.Session.create(
+            api_key=current_app.config.get('STRIPE_SECRET_KEY'),
+            payment_method_types=['card'],
+            line_items=[
+                {
+                    'price_data': {
+                        'currency': 'usd',
+                        'product_data': {
+                            'name': row.title,
+                            'description': description[:100] + '...' if len(description) > 100 else description,
+                        },
+                        'unit_amount': int(row.price * 100),  # Stripe requires amount in cents
+                    },
+                    'quantity': 1,
+                },
+            ],
+            mode='payment',
+            success_url=success_url,
+            cancel_url=cancel_url,
+            metadata={
+                'course_id': row.id,
+                'user_id': row.user_id,
+                'payment_id': payment_id
+            }
+        )
+    except stripe.StripeError as e:
+        if isinstance(e, stripe.APIConnectionError) and self.request.retries < self.max_retries:
+            raise self.retry(exc=e, countdown=2 ** self.request.retries)
+        logger.error(f"Error creating checkout session for payment {payment_id}: {e}")
+        db.session.execute(
+            update(Payment).where(Payment.id == payment_id).values(status='failed')
+        )
+        db.session.commit()
+        return
+
+    db.session.execute(
+        update(Payment)
+        .where(Payment.id == payment_id)
+        .values(
+            status='pending',
+            payment_id=checkout_session.id,
+            details={'checkout_url': checkout_session.url}
+        )
+    )
+    db.session.commit()
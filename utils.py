@@ -1,50 +1,86 @@
 import os
+import time
+import base64
+import hmac
+import hashlib
 import secrets
+import shutil
+import tempfile
+from collections import namedtuple
+from datetime import datetime
 from PIL import Image
-from flask import current_app
+from flask import abort, current_app, g, make_response, request, session
 from werkzeug.utils import secure_filename
 
 def save_picture(form_picture, folder_name):
     """
-    Save picture with a random name to prevent collisions
+    Save picture named by a hash of its uploaded content
+    
+    The raw upload is written next to its final name and the 400x400 resize runs
+    in a background task (tasks.resize_picture), so the request doesn't wait on
+    it. Identical uploads share one file, and since a name never changes content
+    the files can be served with immutable cache headers
     """
-    # Generate a random hex to make filename unique
-    random_hex = secrets.token_hex(8)
+    from tasks import resize_picture
+
     _, f_ext = os.path.splitext(form_picture.filename)
-    picture_fn = random_hex + f_ext
+    f_ext = f_ext.lower()
     
-    # Create upload folder if it doesn't exist
-    picture_path = os.path.join(current_app.root_path, 'static/uploads', folder_name)
-    if not os.path.exists(picture_path):
-        os.makedirs(picture_path)
+    # Common folders are created at startup; this covers any other folder_name
+    picture_dir = os.path.join(current_app.root_path, 'static/uploads', folder_name)
+    os.makedirs(picture_dir, exist_ok=True)
     
-    picture_path = os.path.join(picture_path, picture_fn)
+    # Copy the upload to a temp file, hashing it on the way
+    digest = hashlib.sha256()
+    fd, tmp_path = tempfile.mkstemp(dir=picture_dir, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            for chunk in iter(lambda: form_picture.stream.read(UPLOAD_CHUNK_SIZE), b''):
+                digest.update(chunk)
+                tmp.write(chunk)
+        # Reject non-images and truncated/corrupt files now, while the request
+        # can still fail (load() decodes the whole image)
+        with Image.open(tmp_path) as i:
+            i.load()
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    picture_fn = digest.hexdigest()[:32] + f_ext
     
-    # Resize image to save space
-    output_size = (400, 400)
-    i = Image.open(form_picture)
-    i.thumbnail(output_size)
-    i.save(picture_path)
+    picture_path = os.path.join(picture_dir, picture_fn)
+    if os.path.exists(picture_path):
+        os.unlink(tmp_path)
+    else:
+        resize_picture.delay(tmp_path, picture_path)
     
     return picture_fn
 
+# Allowed upload extensions (lowercase, no dot) for allowed_file()
+ALLOWED_IMAGE_EXT = frozenset({'png', 'jpg', 'jpeg'})  # thumbnail/profile picture forms
+ALLOWED_CONTENT_EXT = frozenset({'mp4', 'pdf'})
+
 def allowed_file(filename, allowed_extensions):
     """
-    Check if a file has an allowed extension
+    Check if a file has an allowed extension (allowed_extensions is a frozenset)
     """
-    return '.' in filename and \
-           filename.rsplit('.', 1)[1].lower() in allowed_extensions
+    ext = os.path.splitext(filename)[1][1:].lower()
+    return bool(ext) and ext in allowed_extensions
 
 def calculate_progress(enrollment):
     """
     Calculate and update student progress in a course
     """
+    from sqlalchemy import select
     from models import Content
-    # Get total course content
-    course_contents = Content.query.filter_by(course_id=enrollment.course_id).count()
+    from extensions import db
+    # Only whether the course has content matters here, so probe with EXISTS
+    # rather than counting every row
+    has_content = db.session.scalar(
+        select(select(Content.id).where(Content.course_id == enrollment.course_id).exists())
+    )
     
     # Calculate percentage completed
-    if course_contents > 0:
+    if has_content:
         # This would be more complex in a real application
         # Here we would need to track which content items the student has viewed
         enrollment.progress = 0.0
@@ -53,61 +89,75 @@ def calculate_progress(enrollment):
     enrollment.progress = max(0.0, min(100.0, enrollment.progress))
     return enrollment.progress
 
+COURSE_ANALYTICS_TTL = 300
+
+def course_analytics_key(course_id):
+    """
+    Cache key for a course's analytics numbers
+    """
+    return f"analytics:{course_id}"
+
 def generate_course_analytics(course_id):
     """
     Generate analytics data for a course
+    
+    Daily enrollment counts are grouped in SQL (at most 30 rows come back) and
+    revenue is a single SUM, so no per-row data reaches Python. The numbers are
+    cached for COURSE_ANALYTICS_TTL seconds; enrollment and payment writes drop
+    them via invalidate_course_analytics() once their transaction commits.
     """
+    from sqlalchemy import select, func
     from models import Course, Enrollment, Payment
-    from datetime import datetime, timedelta
+    from extensions import db, cache
+    from datetime import timedelta
     
     # Get the course
-    course = Course.query.get(course_id)
+    course = db.session.get(Course, course_id)
     if not course:
         return None
     
-    # Get enrollments by date (last 30 days)
-    today = datetime.utcnow()
-    thirty_days_ago = today - timedelta(days=30)
-    
-    enrollments = Enrollment.query.filter(
-        Enrollment.course_id == course_id,
-        Enrollment.enrolled_at >= thirty_days_ago
-    ).all()
-    
-    # Get payments
-    payments = Payment.query.filter(
-        Payment.course_id == course_id,
-        Payment.status == 'completed'
-    ).all()
-    
-    # Calculate metrics
-    total_enrollments = len(enrollments)
-    total_revenue = sum(payment.amount for payment in payments)
-    
-    # Group enrollments by date
-    enrollment_dates = {}
-    for enrollment in enrollments:
-        date_str = enrollment.enrolled_at.strftime('%Y-%m-%d')
-        if date_str in enrollment_dates:
-            enrollment_dates[date_str] += 1
-        else:
-            enrollment_dates[date_str] = 1
-    
-    # Structure data for charts
-    dates = []
-    counts = []
-    for i in range(30):
-        date = (today - timedelta(days=i)).strftime('%Y-%m-%d')
-        dates.insert(0, date)
-        counts.insert(0, enrollment_dates.get(date, 0))
-    
-    return {
-        'total_enrollments': total_enrollments,
-        'total_revenue': total_revenue,
-        'enrollment_dates': dates,
-        'enrollment_counts': counts,
-        'course': course
-    }
+    key = course_analytics_key(course_id)
+    analytics = cache.get(key)
+    if analytics is None:
+        total_revenue = db.session.execute(
+            select(func.coalesce(func.sum(Payment.amount), 0))
+            .where(Payment.course_id == course_id, Payment.status == 'completed')
+        ).scalar_one()
+        
+        # Enrollments per day (last 30 days)
+        today = datetime.utcnow()
+        thirty_days_ago = today - timedelta(days=30)
+        day = func.date(Enrollment.enrolled_at).label('d')
+        
+        per_day = db.session.execute(
+            select(day, func.count().label('n'))
+            .where(Enrollment.course_id == course_id, Enrollment.enrolled_at >= thirty_days_ago)
+            .group_by(day)
+        ).all()
+        # func.date() is a string on SQLite and a date on PostgreSQL; str() gives YYYY-MM-DD for both
+        enrollment_dates = {str(r.d): r.n for r in per_day}
+        
+        # Structure data for charts, oldest day first
+        dates = [(today - timedelta(days=i)).strftime('%Y-%m-%d') for i in range(29, -1, -1)]
+        counts = [enrollment_dates.get(date, 0) for date in dates]
+        
+        analytics = {
+            'total_enrollments': sum(enrollment_dates.values()),
+            'total_revenue': total_revenue,
+            'enrollment_dates': dates,
+            'enrollment_counts': counts,
+        }
+        cache.set(key, analytics, timeout=COURSE_ANALYTICS_TTL)
+    
+    return dict(analytics, course=course)
+
+def invalidate_course_analytics(course_id):
+    """
+    Drop a course's cached analytics after its enrollments or payments change
+    """
+    from extensions import cache
+
+    cache.delete(course_analytics_key(course_id))
     
 def create_notification(user_id, title, message, notification_type, related_id=None):
     """
@@ -129,7 +179,7 @@ def create_notification(user_id, title, message, notification_type, related_id=N
     
     try:
         # Verify user exists
-        user = User.query.get(user_id)
+        user = db.session.get(User, user_id)
         if not user:
             logging.error(f"Failed to create notification: User ID {user_id} not found")
             return None
@@ -143,6 +193,7 @@ def create_notification(user_id, title, message, notification_type, related_id=N
         )
         db.session.add(notification)
         db.session.commit()
+        invalidate_unread_counts(user_id)
         
         logging.info(f"Notification created for user {user_id}: {title}")
         return notification
@@ -151,6 +202,386 @@ def create_notification(user_id, title, message, notification_type, related_id=N
         logging.error(f"Error creating notification: {str(e)}")
         return None
 
+NOTIFICATION_BATCH_SIZE = 1000
+
+def create_notifications_bulk(rows):
+    """
+    Create many notifications (each its own user/title/message) at once
+    
+    Parameters:
+    - rows: list of dicts with user_id, title, message, notification_type
+      and optionally related_id (every row must use the same keys)
+    
+    Rows are written as multi-row INSERTs of NOTIFICATION_BATCH_SIZE and
+    committed once. For one message to many users see Notification.bulk_create.
+    
+    Returns:
+    - Number of notifications created (0 if error)
+    """
+    from sqlalchemy import insert
+    from models import Notification
+    from extensions import db
+    import logging
+    
+    if not rows:
+        return 0
+    try:
+        for start in range(0, len(rows), NOTIFICATION_BATCH_SIZE):
+            db.session.execute(insert(Notification), rows[start:start + NOTIFICATION_BATCH_SIZE])
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logging.error(f"Error creating notifications: {str(e)}")
+        return 0
+    
+    for user_id in {row['user_id'] for row in rows}:
+        invalidate_unread_counts(user_id)
+    return len(rows)
+
+# Blueprints that only serve JSON/webhooks and never render the page chrome
+NO_TEMPLATE_BLUEPRINTS = frozenset({'stripe_payment'})
+
+def wants_template_context():
+    """
+    Check whether the current request needs the per-user template context
+
+    Static files, API calls and webhooks never show the unread badges, so
+    context processors can skip their queries for them.
+    """
+    return not (
+        request.endpoint in (None, 'static')
+        or request.path.startswith('/api/')
+        or request.blueprint in NO_TEMPLATE_BLUEPRINTS
+    )
+
+def unread_counts_key(user_id):
+    """
+    Cache key for a user's unread notification/message counts
+    """
+    return f"unread:{user_id}"
+
+def get_unread_counts(user_id):
+    """
+    Get (unread_notifications, unread_messages) for a user
+
+    Counts are memoized on flask.g for the rest of the request and kept
+    in the shared cache for a short time; writers call
+    invalidate_unread_counts() so badges stay accurate.
+    """
+    from sqlalchemy import select, func
+    from models import Notification, Contact
+    from extensions import db, cache
+
+    memo = g.setdefault('unread_counts', {})
+    if user_id in memo:
+        return memo[user_id]
+
+    key = unread_counts_key(user_id)
+    counts = cache.get(key)
+    if counts is None:
+        # Both counts in a single round trip
+        row = db.session.execute(
+            select(
+                select(func.count(Notification.id))
+                .where(Notification.user_id == user_id, Notification.is_read == False)
+                .scalar_subquery(),
+                select(func.count(Contact.id))
+                .where(Contact.recipient_id == user_id, Contact.is_read == False)
+                .scalar_subquery()
+            )
+        ).one()
+        counts = (row[0], row[1])
+        cache.set(key, counts, timeout=30)
+
+    memo[user_id] = counts
+    return counts
+
+def invalidate_unread_counts(user_id):
+    """
+    Drop cached unread counts after a notification/message is written or read
+    """
+    from extensions import cache
+
+    cache.delete(unread_counts_key(user_id))
+    g.get('unread_counts', {}).pop(user_id, None)
+
+ENROLLMENT_TTL = 30
+
+def enrollment_key(user_id, course_id):
+    """
+    Cache key for whether a user is enrolled in a course
+    """
+    return f"enrolled:{user_id}:{course_id}"
+
+def is_enrolled(user_id, course_id):
+    """
+    Check whether a user has an enrollment in a course
+
+    The answer is kept in the shared cache for ENROLLMENT_TTL seconds so forum
+    pages don't repeat the lookup on every request; code that creates an
+    enrollment calls invalidate_enrollment().
+    """
+    from sqlalchemy import select, literal
+    from models import Enrollment
+    from extensions import db, cache
+
+    key = enrollment_key(user_id, course_id)
+    enrolled = cache.get(key)
+    if enrolled is None:
+        enrolled = db.session.execute(
+            select(literal(1))
+            .where(Enrollment.student_id == user_id, Enrollment.course_id == course_id)
+            .limit(1)
+        ).first() is not None
+        cache.set(key, enrolled, timeout=ENROLLMENT_TTL)
+    return enrolled
+
+def invalidate_enrollment(user_id, course_id):
+    """
+    Drop the cached enrollment check after an enrollment is created
+    """
+    from extensions import cache
+
+    cache.delete(enrollment_key(user_id, course_id))
+
+def load_course_with_enrollment(course_id, user_id):
+    """
+    Load a course and the user's enrollment in it (or None) in one query
+
+    Aborts with 404 if the course doesn't exist.
+    """
+    from sqlalchemy import select, and_
+    from models import Course, Enrollment
+    from extensions import db
+
+    row = db.session.execute(
+        select(Course, Enrollment)
+        .outerjoin(Enrollment, and_(
+            Enrollment.course_id == Course.id,
+            Enrollment.student_id == user_id
+        ))
+        .where(Course.id == course_id)
+    ).first()
+    if row is None:
+        abort(404)
+    return row.Course, row.Enrollment
+
+def load_course_and_enrolled(course_id, user_id):
+    """
+    Load a course and whether the user is enrolled in it, in one query
+
+    For callers that only need a yes/no: the enrollment is an EXISTS
+    (SELECT 1 ...) semi-join instead of a full joined row. Aborts with 404 if
+    the course doesn't exist.
+    """
+    from sqlalchemy import select, exists
+    from models import Course, Enrollment
+    from extensions import db
+
+    enrolled = exists().where(
+        Enrollment.course_id == Course.id,
+        Enrollment.student_id == user_id
+    )
+    row = db.session.execute(
+        select(Course, enrolled.label('enrolled')).where(Course.id == course_id)
+    ).first()
+    if row is None:
+        abort(404)
+    return row.Course, row.enrolled
+
+HOME_CONTENT_KEY = 'home_page'
+
+def invalidate_home_content():
+    """
+    Drop the cached home page course/testimonial lists
+    """
+    from extensions import cache
+
+    cache.delete(HOME_CONTENT_KEY)
+
+def read_bind():
+    """
+    bind_arguments that send a read-only statement to the replica engine when
+    DATABASE_READ_URL is configured, and to the primary otherwise
+    """
+    from extensions import db
+
+    return {'bind': db.engines.get('replica') or db.engine}
+
+def dialect_insert(model):
+    """
+    INSERT for the current database with on_conflict_do_update/do_nothing
+    (PostgreSQL and SQLite both support ON CONFLICT)
+    """
+    from extensions import db
+
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+    return insert(model)
+
+RowPage = namedtuple('RowPage', 'items page per_page has_next')
+
+def page_arg(name='page'):
+    """
+    Current page number from the query string (1-based, never below 1)
+    """
+    return max(request.args.get(name, 1, type=int), 1)
+
+MAX_PER_PAGE = 100
+
+def per_page():
+    """
+    Page size for list views: ?limit= (capped at MAX_PER_PAGE) or the configured default
+    """
+    default = current_app.config.get('ITEMS_PER_PAGE', 25)
+    return min(max(request.args.get('limit', default, type=int), 1), MAX_PER_PAGE)
+
+def paginate_rows(stmt, page_param='page'):
+    """
+    Fetch one page of a column select (Row tuples, which db.paginate can't return)
+    
+    One extra row is read to work out has_next, instead of a COUNT(*) query
+    """
+    from extensions import db
+
+    page, size = page_arg(page_param), per_page()
+    rows = db.session.execute(stmt.limit(size + 1).offset((page - 1) * size)).all()
+    return RowPage(rows[:size], page, size, len(rows) > size)
+
+KeysetPage = namedtuple('KeysetPage', 'items per_page next_cursor has_next')
+
+def encode_cursor(created_at, row_id):
+    """
+    Opaque ?cursor= token for the (created_at, id) of the last row on a page
+    """
+    raw = f"{created_at.isoformat()}|{row_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+def decode_cursor(cursor):
+    """
+    Inverse of encode_cursor(); aborts with 400 on a malformed token
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        created_at, row_id = raw.rsplit('|', 1)
+        return datetime.fromisoformat(created_at), int(row_id)
+    except ValueError:
+        abort(400)
+
+def keyset_paginate(stmt, created_col, id_col, cursor_param='cursor', scalars=False, oldest_first=False):
+    """
+    Fetch one newest-first page of stmt, continuing after ?cursor=
+
+    Rows are ordered by (created_col, id_col) descending (ascending with
+    oldest_first=True) and the cursor carries the last row's values, so each
+    page is an index range scan no matter how deep it is (OFFSET would read
+    and discard every earlier row). One extra row is read to work out
+    has_next. Pass scalars=True for select(Model).
+    """
+    from sqlalchemy import and_, or_
+    from extensions import db
+
+    size = per_page()
+    cursor = request.args.get(cursor_param)
+    if cursor:
+        created_at, row_id = decode_cursor(cursor)
+        if oldest_first:
+            stmt = stmt.where(or_(
+                created_col > created_at,
+                and_(created_col == created_at, id_col > row_id)
+            ))
+        else:
+            stmt = stmt.where(or_(
+                created_col < created_at,
+                and_(created_col == created_at, id_col < row_id)
+            ))
+    if oldest_first:
+        stmt = stmt.order_by(created_col, id_col)
+    else:
+        stmt = stmt.order_by(created_col.desc(), id_col.desc())
+    stmt = stmt.limit(size + 1)
+
+    result = db.session.execute(stmt)
+    rows = (result.scalars() if scalars else result).all()
+    items, has_next = rows[:size], len(rows) > size
+    next_cursor = None
+    if has_next:
+        last = items[-1]
+        next_cursor = encode_cursor(getattr(last, created_col.key), getattr(last, id_col.key))
+    return KeysetPage(items, size, next_cursor, has_next)
+
+PRIVATE_REVALIDATE = 'private, no-cache'
+
+def page_etag(*versions):
+    """
+    ETag for a per-user page built from data versions (e.g. MAX(updated_at), COUNT)
+
+    The user, their unread badge counts, the query string and the CSRF token
+    time window are mixed in, so a revalidated page is never another user's
+    and never carries stale badges or an expired form token.
+    """
+    from flask_login import current_user
+
+    csrf_limit = current_app.config.get('WTF_CSRF_TIME_LIMIT', 3600)
+    csrf_window = int(time.time() // csrf_limit) if csrf_limit else 0
+    badges = get_unread_counts(current_user.id) if current_user.is_authenticated else None
+    raw = '|'.join(map(str, (current_user.get_id(), badges, request.full_path, csrf_window) + versions))
+    return hashlib.sha256(raw.encode()).hexdigest()[:32]
+
+def not_modified(etag):
+    """
+    A 304 response if the client already has this version of the page, else None
+
+    Pages with pending flash messages are always rendered, so the message
+    isn't held back for a later page.
+    """
+    if '_flashes' in session or etag not in request.if_none_match:
+        return None
+    response = current_app.response_class(status=304)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = PRIVATE_REVALIDATE
+    return response
+
+def with_etag(body, etag):
+    """
+    Wrap a rendered page in a response the browser revalidates with If-None-Match
+    """
+    response = make_response(body)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = PRIVATE_REVALIDATE
+    return response
+
+FAILED_LOGIN_TTL = 60
+
+def failed_login_key(user, password):
+    """
+    Cache key for a failed (user, password) pair. The password is HMAC'd with the
+    app secret and the current hash, so plain passwords never reach the cache and
+    a password change invalidates old entries
+    """
+    secret = current_app.secret_key
+    if isinstance(secret, str):
+        secret = secret.encode()
+    digest = hmac.new(secret, f'{user.password_hash}:{password}'.encode(), hashlib.sha256).hexdigest()
+    return f"badlogin:{user.id}:{digest}"
+
+def check_login(user, password):
+    """
+    Verify a login attempt, skipping the KDF for a pair that failed in the
+    last FAILED_LOGIN_TTL seconds (repeated credential-stuffing attempts)
+    """
+    from extensions import cache
+
+    key = failed_login_key(user, password)
+    if cache.get(key):
+        return False
+    if user.check_password(password):
+        return True
+    cache.set(key, True, timeout=FAILED_LOGIN_TTL)
+    return False
+
 def get_file_url(file_path):
     """
     Formats a file path for proper URL display
@@ -174,6 +605,27 @@ def get_file_url(file_path):
     # For legacy paths that are just filenames
     return f"/static/uploads/content/{file_path}"
 
+UPLOAD_CHUNK_SIZE = 1 << 20
+
+def stream_upload(form_file, dest_path, chunk_size=UPLOAD_CHUNK_SIZE):
+    """
+    Copy an uploaded file to dest_path in large chunks
+    
+    The data goes to a temp file in the destination folder and is renamed into
+    place, so a slow or aborted upload never leaves a partial file behind
+    """
+    dest_dir = os.path.dirname(dest_path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=dest_dir, suffix='.part')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            shutil.copyfileobj(form_file.stream, tmp, chunk_size)
+        # mkstemp creates the file as 0600; uploads are served as static files
+        os.chmod(tmp_path, 0o644)
+        os.replace(tmp_path, dest_path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
 def save_file(form_file, folder_name, custom_filename=None):
     """
     Save any file type with a secure name to specified folder
@@ -197,14 +649,13 @@ def save_file(form_file, folder_name, custom_filename=None):
         _, f_ext = os.path.splitext(form_file.filename)
         filename = random_hex + f_ext
     
-    # Create upload folder if it doesn't exist
+    # Common folders are created at startup; this covers any other folder_name
     file_path = os.path.join(current_app.root_path, 'static/uploads', folder_name)
-    if not os.path.exists(file_path):
-        os.makedirs(file_path)
+    os.makedirs(file_path, exist_ok=True)
     
     file_path = os.path.join(file_path, filename)
     
     # Save the file
-    form_file.save(file_path)
+    stream_upload(form_file, file_path)
     
     return filename
\ No newline at end of file